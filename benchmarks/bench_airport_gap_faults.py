@@ -0,0 +1,103 @@
+# -*- coding: utf-8 -*-
+"""Verifica il client Airport Gap (timeout, retry, circuit breaker, cache negativa) con guasti simulati.
+
+Ogni scenario avvia un Airport Gap finto locale che inietta latenza ed errori e misura,
+per le chiamate a get_distance_with_api, esiti, tempi e chiamate rifiutate dal circuito:
+
+    python benchmarks/bench_airport_gap_faults.py --calls 200
+"""
+import argparse
+import json
+import os
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from http.server import ThreadingHTTPServer
+
+os.environ.setdefault("AIRPORT_GAP_API_KEY", "benchmark")
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import server  # noqa: E402
+from tests.fake_airport_gap import make_stub_handler  # noqa: E402
+
+# nome -> (latenza in secondi, quota di errori, stato HTTP degli errori, codici sconosciuti, Retry-After)
+SCENARIOS = {
+    "healthy": (0.005, 0.0, 503, (), None),
+    "flaky_503": (0.005, 0.3, 503, (), None),
+    "rate_limited": (0.005, 0.5, 429, (), "0"),
+    "down": (0.005, 1.0, 503, (), None),
+    "unauthorized": (0.005, 1.0, 401, (), None),
+    "hung": (5.0, 0.0, 503, (), None),
+    "unknown_codes": (0.005, 0.0, 503, ("ZZZ",), None),
+}
+
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))] if values else None
+
+
+def run_scenario(name, calls, concurrency):
+    latency, error_rate, error_status, unknown_codes, retry_after = SCENARIOS[name]
+    handler = make_stub_handler(latency, error_rate, error_status, unknown_codes, retry_after)
+    httpd = ThreadingHTTPServer(("127.0.0.1", 0), handler)
+    httpd.daemon_threads = True
+    threading.Thread(target=httpd.serve_forever, daemon=True).start()
+    server.AIRPORT_GAP_URL = f"http://127.0.0.1:{httpd.server_port}/api/airports/distance"
+
+    # Stato pulito per ogni scenario
+    server.airport_gap_breaker = server.CircuitBreaker(server.AIRPORT_GAP_BREAKER_THRESHOLD, server.AIRPORT_GAP_BREAKER_COOLDOWN)
+    server.distance_failures.clear()
+
+    def call(i):
+        to_code = "ZZZ" if unknown_codes and i % 2 else "FCO"
+        start = time.perf_counter()
+        try:
+            server.get_distance_with_api("MXP", to_code)
+            outcome = "ok"
+        except server.AirportGapError:
+            outcome = "route_error"
+        except Exception as e:
+            outcome = "circuit_open" if "circuito" in str(e) else "error"
+        return outcome, time.perf_counter() - start
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        results = list(executor.map(call, range(calls)))
+    elapsed = time.perf_counter() - start
+    httpd.shutdown()
+
+    durations = [duration for _, duration in results]
+    outcomes = {}
+    for outcome, _ in results:
+        outcomes[outcome] = outcomes.get(outcome, 0) + 1
+    return {
+        "scenario": name,
+        "calls": calls,
+        "seconds": round(elapsed, 3),
+        "outcomes": outcomes,
+        "p50_ms": round(percentile(durations, 0.5) * 1000, 2),
+        "p99_ms": round(percentile(durations, 0.99) * 1000, 2),
+        "max_ms": round(max(durations) * 1000, 2),
+        "upstream_calls": handler.calls,
+        "circuit_rejected": server.airport_gap_breaker.rejected,
+        "negative_hits": server.distance_failures.hits,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--calls", type=int, default=200)
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--read-timeout", type=float, default=0.5, help="timeout di lettura (s) per lo scenario hung")
+    parser.add_argument("--scenario", choices=sorted(SCENARIOS), action="append")
+    args = parser.parse_args()
+
+    server.AIRPORT_GAP_TIMEOUT = (server.AIRPORT_GAP_TIMEOUT[0], args.read_timeout)
+    for name in args.scenario or SCENARIOS:
+        print(json.dumps(run_scenario(name, args.calls, args.concurrency)))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,82 @@
+# -*- coding: utf-8 -*-
+"""Micro-benchmark dell'elaborazione colonnare di GAS/ELECTRICITY contro quella per righe.
+
+Genera payload sintetici (10k, 100k e 1M elementi di default), verifica che totali e
+documenti scartati coincidano e stampa i tempi in JSON:
+
+    python benchmarks/bench_columnar.py --sizes 10000 100000
+"""
+import argparse
+import json
+import os
+import random
+import sys
+import time
+
+os.environ.setdefault("MONGO_URI", "mongodb://localhost:27017")  # MongoClient non si connette all'import
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import server  # noqa: E402
+
+ANNO = 2024
+
+
+def make_items(size, value_key):
+    rng = random.Random(size)
+    items = []
+    for i in range(size):
+        year = rng.choice((ANNO - 1, ANNO, ANNO, ANNO + 1))
+        start = f"{year}-{rng.randint(1, 12):02d}-{rng.randint(1, 28):02d}"
+        end = f"{year + (rng.random() < 0.1)}-{rng.randint(1, 12):02d}-{rng.randint(1, 28):02d}"
+        item = {"document_name": f"bolletta_{i}.pdf", "period": {"start_date": start, "end_date": end},
+                value_key: {"value": round(rng.uniform(0, 500), 3)}}
+        roll = rng.random()
+        if roll < 0.01:
+            item["period"]["end_date"] = ""
+        elif roll < 0.02:
+            del item["period"]
+        items.append(item)
+    return items
+
+
+def timed(function, items):
+    start = time.perf_counter()
+    result = function(items, ANNO)
+    return time.perf_counter() - start, result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--sizes", type=int, nargs="+", default=[10_000, 100_000, 1_000_000])
+    args = parser.parse_args()
+
+    results = []
+    for document_type, value_key, row_function, columnar_function in (
+        ("GAS", "consumption_sMc", server.process_gas_items_with_notes, server.process_gas_items_columnar),
+        ("ELECTRICITY", "total_electricity_consumption",
+         server.process_electricity_items_with_notes, server.process_electricity_items_columnar),
+    ):
+        for size in args.sizes:
+            items = make_items(size, value_key)
+            if document_type == "ELECTRICITY":
+                items[size // 2]["period"] = {"start_date": "2024-02-30", "end_date": "2024-03-01"}
+
+            # Forza la versione per righe disattivando la soglia colonnare
+            server.COLUMNAR_MIN_ITEMS = float("inf")
+            row_time, row_result = timed(row_function, items)
+            columnar_time, columnar_result = timed(columnar_function, items)
+
+            results.append({
+                "document_type": document_type,
+                "items": size,
+                "row_seconds": round(row_time, 4),
+                "columnar_seconds": round(columnar_time, 4),
+                "speedup": round(row_time / columnar_time, 1),
+                "identical": row_result == columnar_result,
+            })
+
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,88 @@
+# -*- coding: utf-8 -*-
+"""Confronta il motore locale delle distanze con il percorso HTTP verso Airport Gap.
+
+Il percorso HTTP usa un server finto locale con latenza configurabile, quindi
+non serve alcuna connessione esterna:
+
+    python benchmarks/bench_distance.py --legs 300 --latency-ms 80
+"""
+import argparse
+import json
+import os
+import random
+import sys
+import threading
+import time
+from http.server import ThreadingHTTPServer
+
+os.environ.setdefault("MONGO_URI", "mongodb://localhost:27017")  # MongoClient non si connette all'import
+os.environ.setdefault("AIRPORT_GAP_API_KEY", "benchmark")
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import server  # noqa: E402
+from tests.fake_airport_gap import make_stub_handler  # noqa: E402
+
+
+def make_airports(count):
+    rng = random.Random(42)
+    return [
+        {"iata": "".join(chr(65 + i // 26 ** k % 26) for k in (2, 1, 0)),
+         "latitude": rng.uniform(-60, 70), "longitude": rng.uniform(-180, 180)}
+        for i in range(count)
+    ]
+
+
+def make_items(codes, legs, anno):
+    rng = random.Random(7)
+    return [
+        {"document_name": f"doc_{i}.pdf", "date": f"{anno}-0{rng.randint(1, 9)}-1{rng.randint(0, 9)}",
+         "travel": {"from": rng.choice(codes), "to": rng.choice(codes)}, "num_of_travelers": rng.randint(1, 4)}
+        for i in range(legs)
+    ]
+
+
+def run(table, items, anno):
+    server.airport_table = table
+    start = time.perf_counter()
+    _, total, discarded = server.process_flight_items_with_notes(items, anno)
+    return time.perf_counter() - start, total, discarded
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--legs", type=int, default=300)
+    parser.add_argument("--airports", type=int, default=500)
+    parser.add_argument("--latency-ms", type=float, default=50.0)
+    args = parser.parse_args()
+
+    httpd = ThreadingHTTPServer(("127.0.0.1", 0), make_stub_handler(args.latency_ms / 1000))
+    threading.Thread(target=httpd.serve_forever, daemon=True).start()
+    server.AIRPORT_GAP_URL = f"http://127.0.0.1:{httpd.server_port}/api/airports/distance"
+    # Misura il percorso HTTP puro, senza la cache distanze su MongoDB
+    server.get_cached_distance = server.get_distance_with_api
+
+    airports = make_airports(args.airports)
+    items = make_items([a["iata"] for a in airports], args.legs, 2024)
+
+    # Tabella vuota: ogni tratta passa dal fallback HTTP
+    http_table = server.AirportTable()
+    http_table.load([])
+    http_time, _, http_discarded = run(http_table, items, 2024)
+
+    local_table = server.AirportTable()
+    local_table.load(airports)
+    local_time, _, local_discarded = run(local_table, items, 2024)
+
+    httpd.shutdown()
+    print(json.dumps({
+        "legs": args.legs,
+        "stub_latency_ms": args.latency_ms,
+        "http_seconds": round(http_time, 4),
+        "local_seconds": round(local_time, 4),
+        "speedup": round(http_time / local_time, 1) if local_time else None,
+        "discarded": {"http": len(http_discarded), "local": len(local_discarded)},
+    }, indent=2))
+
+
+if __name__ == "__main__":
+    main()
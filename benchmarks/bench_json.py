@@ -0,0 +1,100 @@
+# -*- coding: utf-8 -*-
+"""Confronta il provider JSON standard di Flask con BSONJSONProvider (orjson) su payload grandi.
+
+Misura la serializzazione della risposta di /get_client_data (dati con molte voci),
+di /get_user_files (prima con la copia di ogni file per convertire gli ObjectId, poi
+diretta) e il parsing del corpo di /add_energy_data:
+
+    python benchmarks/bench_json.py --items 100000
+"""
+import argparse
+import json
+import os
+import random
+import statistics
+import sys
+import time
+from datetime import datetime, timedelta
+
+from bson.objectid import ObjectId
+from flask.json.provider import DefaultJSONProvider
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import server  # noqa: E402
+
+
+def make_client_data(items):
+    rng = random.Random(items)
+    gas = [
+        {"document_name": f"bolletta_{i}.pdf", "period": {"start_date": "2024-01-01", "end_date": "2024-02-01"},
+         "consumption_sMc": {"value": round(rng.uniform(0, 500), 3)}}
+        for i in range(items)
+    ]
+    return {"cliente": "ACME", "timestamp": datetime(2024, 3, 1), "username": "mario",
+            "dati": {"TotalFlightDist": [], "Elettricità": [], "Gas": gas},
+            "utenti": [{"username": "mario", "email": "mario@example.com"}]}
+
+
+def make_files(count):
+    start = datetime(2024, 1, 1)
+    return [
+        {"file_id": ObjectId(), "filename": f"documento_{i}.pdf", "content_type": "application/pdf",
+         "uploaded_at": start + timedelta(minutes=i)}
+        for i in range(count)
+    ]
+
+
+def format_file(file):
+    # Conversione usata da /get_user_files prima del provider BSON
+    return {key: str(value) if isinstance(value, ObjectId) else value for key, value in file.items()}
+
+
+def measure(function, repeat):
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        timings.append(time.perf_counter() - start)
+    return round(statistics.median(timings) * 1000, 2)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--items", type=int, default=100000)
+    parser.add_argument("--files", type=int, default=20000)
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    if server.orjson is None:
+        sys.exit("orjson non installato: BSONJSONProvider usa il modulo json standard")
+
+    app = server.app
+    standard = DefaultJSONProvider(app)
+    fast = server.BSONJSONProvider(app)
+    client_data = make_client_data(args.items)
+    files = make_files(args.files)
+    body = json.dumps({"anno": 2024, "document_type": "GAS", "dati": client_data["dati"]["Gas"]}).encode()
+
+    results = []
+    with app.app_context():
+        scenarios = {
+            "get_client_data response": (
+                lambda: standard.response(client_data), lambda: fast.response(client_data)),
+            "get_user_files response": (
+                lambda: standard.response({"files": {"pdfs": [format_file(file) for file in files]}}),
+                lambda: fast.response({"files": {"pdfs": files}})),
+            "add_energy_data parse": (
+                lambda: standard.loads(body), lambda: fast.loads(body)),
+        }
+        for name, (before, after) in scenarios.items():
+            before_ms = measure(before, args.repeat)
+            after_ms = measure(after, args.repeat)
+            results.append({"scenario": name, "before_ms": before_ms, "after_ms": after_ms,
+                            "speedup": round(before_ms / after_ms, 1) if after_ms else None})
+
+    print(json.dumps({"items": args.items, "files": args.files, "body_bytes": len(body), "results": results}, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,197 @@
+# -*- coding: utf-8 -*-
+"""Benchmark end-to-end di tutte le route di server.py.
+
+Avvia l'app Flask su un server WSGI locale multi-thread, con MongoDB sostituito da
+mongomock (oppure un mongod locale con --mongo-uri) e un finto Airport Gap con latenza
+configurabile. Per ogni route misura p50/p95/p99, richieste al secondo e RSS di picco
+e scrive i risultati in un file JSON confrontabile tra una release e l'altra:
+
+    python benchmarks/bench_routes.py --requests 200 --concurrency 8 --output bench_routes.json
+
+mongomock non è una dipendenza dell'app: installarlo a parte (pip install mongomock).
+"""
+import argparse
+import io
+import json
+import logging
+import os
+import random
+import resource
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from http.server import ThreadingHTTPServer
+
+import requests
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+def import_server(mongo_uri):
+    """Importa server.py puntandolo a un mongod locale oppure a mongomock."""
+    os.environ.setdefault("AIRPORT_GAP_API_KEY", "benchmark")
+    # Misura la capacità delle route, non il controllo di ammissione
+    os.environ.setdefault("RATE_LIMIT_ENABLED", "0")
+    os.environ.setdefault("MAX_IN_FLIGHT", "0")
+    if mongo_uri:
+        os.environ["MONGO_URI"] = mongo_uri
+    else:
+        import mongomock
+        import mongomock.gridfs
+
+        os.environ["MONGO_URI"] = "mongodb://localhost:27017"
+        os.environ["AUTH_CACHE_WATCH"] = "0"  # mongomock non supporta le change stream
+        mongomock.gridfs.enable_gridfs_integration()
+        mongomock.patch(servers=(("localhost", 27017),)).start()
+
+    import server
+    return server
+
+
+def percentile(values, pct):
+    ordered = sorted(values)
+    if not ordered:
+        return None
+    index = min(len(ordered) - 1, max(0, round(pct / 100 * len(ordered)) - 1))
+    return ordered[index]
+
+
+def peak_rss_mb():
+    # ru_maxrss è in KB su Linux e in byte su macOS
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return round(rss / (1024 * 1024 if sys.platform == "darwin" else 1024), 1)
+
+
+def energy_items(document_type, size, codes, rng):
+    if document_type == "BUSINESS_TRAVEL":
+        return [{"document_name": f"volo_{i}.pdf", "date": f"2024-{rng.randint(1, 12):02d}-15",
+                 "travel": {"from": rng.choice(codes), "to": rng.choice(codes)},
+                 "num_of_travelers": rng.randint(1, 3)} for i in range(size)]
+    value_key = "consumption_sMc" if document_type == "GAS" else "total_electricity_consumption"
+    return [{"document_name": f"bolletta_{i}.pdf",
+             "period": {"start_date": f"2024-{rng.randint(1, 6):02d}-01", "end_date": f"2024-{rng.randint(7, 12):02d}-28"},
+             value_key: {"value": round(rng.uniform(10, 500), 2)}} for i in range(size)]
+
+
+def run_scenario(name, send, total, concurrency):
+    """Esegue `total` richieste con `concurrency` thread e raccoglie le latenze."""
+    local = threading.local()
+    latencies = []
+    errors = 0
+    lock = threading.Lock()
+
+    def one(index):
+        nonlocal errors
+        if not hasattr(local, "session"):
+            local.session = requests.Session()
+        start = time.perf_counter()
+        response = send(local.session, index)
+        elapsed = time.perf_counter() - start
+        with lock:
+            latencies.append(elapsed)
+            if response.status_code >= 400:
+                errors += 1
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        list(executor.map(one, range(total)))
+    duration = time.perf_counter() - start
+
+    result = {
+        "route": name,
+        "requests": total,
+        "errors": errors,
+        "rps": round(total / duration, 1),
+        "p50_ms": round(percentile(latencies, 50) * 1000, 2),
+        "p95_ms": round(percentile(latencies, 95) * 1000, 2),
+        "p99_ms": round(percentile(latencies, 99) * 1000, 2),
+        "peak_rss_mb": peak_rss_mb(),
+    }
+    print(json.dumps(result), file=sys.stderr)
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--requests", type=int, default=200, help="richieste per route")
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--items", type=int, default=200, help="elementi per /add_energy_data")
+    parser.add_argument("--upload-kb", type=int, default=512)
+    parser.add_argument("--airport-gap-latency-ms", type=float, default=50.0)
+    parser.add_argument("--mongo-uri", help="mongod locale; di default usa mongomock")
+    parser.add_argument("--output", default="bench_routes.json")
+    args = parser.parse_args()
+
+    server = import_server(args.mongo_uri)
+    # Dopo import_server: bench_distance importa server.py a sua volta
+    from bench_distance import make_airports
+    from tests.fake_airport_gap import make_stub_handler
+    from werkzeug.serving import make_server
+
+    # Finto Airport Gap: metà dei codici non è nella tabella locale e passa dall'API
+    airport_gap = ThreadingHTTPServer(("127.0.0.1", 0), make_stub_handler(args.airport_gap_latency_ms / 1000))
+    threading.Thread(target=airport_gap.serve_forever, daemon=True).start()
+    server.AIRPORT_GAP_URL = f"http://127.0.0.1:{airport_gap.server_port}/api/airports/distance"
+    airports = make_airports(100)
+    server.airport_table.load(airports[:50])
+    codes = [airport["iata"] for airport in airports]
+
+    app = server.create_app()
+    logging.getLogger("werkzeug").setLevel(logging.ERROR)
+    httpd = make_server("127.0.0.1", 0, app, threaded=True)
+    threading.Thread(target=httpd.serve_forever, daemon=True).start()
+    base = f"http://127.0.0.1:{httpd.server_port}"
+
+    # Dati iniziali: un utente associato a un cliente
+    user = requests.post(f"{base}/create_user", json={"username": "bench", "email": "bench@example.com"}).json()["user"]
+    headers = {"X-API-KEY": user["api_key"]}
+    requests.post(f"{base}/create_client", json={"nome": "BenchClient"})
+    requests.post(f"{base}/associate_user_to_client", json={"nome_cliente": "BenchClient", "username": "bench"})
+
+    rng = random.Random(1)
+    payloads = {
+        document_type: {"anno": 2024, "document_type": document_type, "dati": energy_items(document_type, args.items, codes, rng)}
+        for document_type in ("GAS", "ELECTRICITY", "BUSINESS_TRAVEL")
+    }
+    upload_body = os.urandom(args.upload_kb * 1024)
+    uploaded = requests.post(f"{base}/upload", headers=headers,
+                             files={"file": ("seed.pdf", io.BytesIO(upload_body), "application/pdf")}).json()
+    file_id = uploaded["uploaded_files"][0]["file_id"]
+
+    scenarios = [
+        ("POST /create_user", lambda session, i: session.post(
+            f"{base}/create_user", json={"username": f"user{i}", "email": f"user{i}-{time.time_ns()}@example.com"})),
+        ("POST /add_energy_data GAS", lambda session, i: session.post(
+            f"{base}/add_energy_data", headers=headers, json=payloads["GAS"])),
+        ("POST /add_energy_data ELECTRICITY", lambda session, i: session.post(
+            f"{base}/add_energy_data", headers=headers, json=payloads["ELECTRICITY"])),
+        ("POST /add_energy_data BUSINESS_TRAVEL", lambda session, i: session.post(
+            f"{base}/add_energy_data", headers=headers, json=payloads["BUSINESS_TRAVEL"])),
+        ("GET /get_client_data", lambda session, i: session.get(
+            f"{base}/get_client_data", headers=headers, params={"nome": "BenchClient"})),
+        ("POST /upload", lambda session, i: session.post(
+            f"{base}/upload", headers=headers,
+            # Contenuti distinti, così la deduplicazione non salta le scritture
+            files={"file": (f"file{i}.pdf", io.BytesIO(upload_body + str(i).encode()), "application/pdf")})),
+        ("GET /download", lambda session, i: session.get(
+            f"{base}/download", headers=headers, params={"file_id": file_id})),
+        ("GET /get_user_files", lambda session, i: session.get(f"{base}/get_user_files", headers=headers)),
+    ]
+
+    results = [run_scenario(name, send, args.requests, args.concurrency) for name, send in scenarios]
+
+    httpd.shutdown()
+    airport_gap.shutdown()
+    report = {
+        "config": {key: value for key, value in vars(args).items() if key != "output"},
+        "python": sys.version.split()[0],
+        "results": results,
+    }
+    with open(args.output, "w", encoding="utf-8") as output:
+        json.dump(report, output, indent=2)
+    print(f"Risultati scritti in {args.output}", file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,39 @@
+# -*- coding: utf-8 -*-
+"""Configurazione gunicorn per la produzione: gunicorn -c gunicorn.conf.py server:app
+
+L'app viene caricata nel master prima del fork (preload_app) senza aprire connessioni:
+MongoClient, GridFS e i pool di thread vengono creati in ogni worker in post_fork.
+"""
+import multiprocessing
+import os
+
+bind = f"0.0.0.0:{os.getenv('PORT', '5000')}"
+
+# Processi pre-fork (uno per core di default) con più thread ciascuno
+workers = int(os.getenv("WEB_CONCURRENCY", multiprocessing.cpu_count()))
+worker_class = "gthread"
+threads = int(os.getenv("GUNICORN_THREADS", "8"))
+# Le richieste oltre i thread attendono nella coda di gunicorn, invisibili al limite MAX_IN_FLIGHT
+# dell'app: per rifiutarle con 503 impostare MAX_QUEUE_WAIT_MS (richiede l'header X-Request-Start dal proxy)
+
+timeout = int(os.getenv("GUNICORN_TIMEOUT", "120"))
+graceful_timeout = int(os.getenv("GUNICORN_GRACEFUL_TIMEOUT", "30"))
+keepalive = int(os.getenv("GUNICORN_KEEPALIVE", "5"))
+max_requests = int(os.getenv("GUNICORN_MAX_REQUESTS", "0"))
+max_requests_jitter = int(os.getenv("GUNICORN_MAX_REQUESTS_JITTER", "0"))
+
+preload_app = True
+accesslog = "-"
+
+
+def post_fork(server, worker):
+    # Il client MongoDB non è fork-safe: ogni worker crea il proprio dopo il fork
+    import server as application
+
+    application.create_app()
+
+
+def worker_exit(server, worker):
+    import server as application
+
+    application.shutdown()
@@ -1,31 +1,378 @@
 ﻿# -*- coding: utf-8 -*-
-from flask import Flask, request, jsonify,  send_file
-from pymongo import MongoClient
+from flask import Flask, request, jsonify,  send_file, stream_with_context, g
+from flask.json.provider import DefaultJSONProvider
+from pymongo import MongoClient, ReplaceOne, ReturnDocument, UpdateOne, monitoring
+from pymongo.errors import BulkWriteError, DuplicateKeyError, OperationFailure, PyMongoError
+from werkzeug.exceptions import HTTPException
+from werkzeug.http import parse_date, parse_options_header
+from werkzeug.sansio.multipart import MultipartDecoder, Data, Epilogue, Field, File, NeedData
+from werkzeug.utils import secure_filename
+from bson.binary import Binary
 from bson.objectid import ObjectId
-from datetime import datetime
-from io import BytesIO
+from datetime import date, datetime, timedelta, timezone
+from io import BytesIO, StringIO
+import csv
 import gridfs
+import hashlib
 import secrets
+import socket
+import sys
 import base64
 import os
 import math
+import random
+import re
 import requests
+import threading
+import time
+import zlib
+from array import array
+from collections import Counter, OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 
-app = Flask(__name__)
-
-# Stringa di connessione a MongoDB Atlas
-mongo_uri = os.getenv("MONGO_URI")
-if not mongo_uri:
-    raise Exception("La variabile MONGO_URI non è configurata!")
+try:
+    import orjson
+except ImportError:  # Dipendenza opzionale: senza orjson si usa il modulo json standard
+    orjson = None
+
+class BSONJSONProvider(DefaultJSONProvider):
+    """Provider JSON di Flask basato su orjson, con supporto diretto a ObjectId e Binary.
+
+    Le date restano nel formato HTTP del provider standard; senza orjson (o con opzioni
+    e valori non supportati da orjson, come interi oltre 64 bit o NaN) si ricade sul
+    comportamento di DefaultJSONProvider.
+    """
+
+    ORJSON_DUMPS_KWARGS = {"default", "ensure_ascii", "sort_keys", "indent", "separators"}
+    # Numeri di 20 o più cifre: orjson convertirebbe in float gli interi oltre 64 bit
+    LONG_NUMBER = re.compile(r"\d{20,}")
+    LONG_NUMBER_BYTES = re.compile(rb"\d{20,}")
+
+    @staticmethod
+    def default(o):
+        if isinstance(o, ObjectId):
+            return str(o)
+        if isinstance(o, (Binary, bytes)):
+            return base64.b64encode(o).decode("ascii")
+        return DefaultJSONProvider.default(o)
+
+    def orjson_options(self, sort_keys=None, indent=None):
+        # Le date passano da default() per mantenere il formato HTTP (es. "Mon, 01 Jan 2024 00:00:00 GMT")
+        option = orjson.OPT_PASSTHROUGH_DATETIME | orjson.OPT_NON_STR_KEYS
+        if self.sort_keys if sort_keys is None else sort_keys:
+            option |= orjson.OPT_SORT_KEYS
+        if indent:
+            option |= orjson.OPT_INDENT_2
+        return option
+
+    def dumps(self, obj, **kwargs):
+        if orjson is None or kwargs.keys() - self.ORJSON_DUMPS_KWARGS:
+            kwargs.setdefault("default", self.default)
+            return super().dumps(obj, **kwargs)
+        option = self.orjson_options(kwargs.get("sort_keys"), kwargs.get("indent"))
+        try:
+            return orjson.dumps(obj, default=kwargs.get("default", self.default), option=option).decode()
+        except orjson.JSONEncodeError:
+            # Es. interi oltre 64 bit: il modulo json standard li serializza
+            kwargs.setdefault("default", self.default)
+            return super().dumps(obj, **kwargs)
+
+    def loads(self, s, **kwargs):
+        if orjson is None or kwargs:
+            return super().loads(s, **kwargs)
+        pattern = self.LONG_NUMBER_BYTES if isinstance(s, (bytes, bytearray)) else self.LONG_NUMBER
+        if pattern.search(s):
+            return super().loads(s)
+        try:
+            return orjson.loads(s)
+        except orjson.JSONDecodeError:
+            # NaN e Infinity sono accettati dal modulo json standard; il resto resta un errore
+            return super().loads(s)
+
+    def response(self, *args, **kwargs):
+        if orjson is None:
+            return super().response(*args, **kwargs)
+        obj = self._prepare_response_obj(args, kwargs)
+        indent = (self.compact is None and self._app.debug) or self.compact is False
+        # Serializza direttamente in bytes, senza passare da una stringa intermedia
+        try:
+            body = orjson.dumps(obj, default=self.default, option=self.orjson_options(indent=indent) | orjson.OPT_APPEND_NEWLINE)
+        except orjson.JSONEncodeError:
+            return super().response(*args, **kwargs)
+        return self._app.response_class(body, mimetype=self.mimetype)
 
-# Connessione al database MongoDB Atlas
-client = MongoClient(mongo_uri)
-db = client["my_database"]  # Nome del database trasferito
-users_collection = db["users"]
-client_collection = db["clients"]
-airports_collection = db["airports"]
-fs = gridfs.GridFS(db)  # GridFS per file grandi
+app = Flask(__name__)
+app.json = BSONJSONProvider(app)
+
+# --- Metriche (formato Prometheus, esposte su /metrics) ---
+
+METRICS = []
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+def format_labels(names, values):
+    if not names:
+        return ""
+    escaped = (str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") for value in values)
+    return "{" + ",".join(f'{name}="{value}"' for name, value in zip(names, escaped)) + "}"
+
+class CounterMetric:
+    """Contatore monotono con etichette."""
+
+    def __init__(self, name, help_text, labels=()):
+        self.name = name
+        self.help_text = help_text
+        self.labels = labels
+        self.values = {}
+        self._lock = threading.Lock()
+        METRICS.append(self)
+
+    def inc(self, amount=1, *label_values):
+        with self._lock:
+            self.values[label_values] = self.values.get(label_values, 0) + amount
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} counter"]
+        with self._lock:
+            for label_values, value in self.values.items():
+                lines.append(f"{self.name}{format_labels(self.labels, label_values)} {value}")
+        return lines
+
+class HistogramMetric:
+    """Istogramma cumulativo con etichette."""
+
+    def __init__(self, name, help_text, labels=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.help_text = help_text
+        self.labels = labels
+        self.buckets = buckets
+        self.values = {}  # etichette -> [conteggi per bucket, somma, conteggio]
+        self._lock = threading.Lock()
+        METRICS.append(self)
+
+    def observe(self, value, *label_values):
+        with self._lock:
+            entry = self.values.get(label_values)
+            if entry is None:
+                entry = self.values[label_values] = [[0] * len(self.buckets), 0.0, 0]
+            for position, bound in enumerate(self.buckets):
+                if value <= bound:
+                    entry[0][position] += 1
+                    break
+            entry[1] += value
+            entry[2] += 1
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} histogram"]
+        bucket_labels = self.labels + ("le",)
+        with self._lock:
+            for label_values, (counts, total, count) in self.values.items():
+                cumulative = 0
+                for bound, bucket_count in zip(self.buckets, counts):
+                    cumulative += bucket_count
+                    lines.append(f"{self.name}_bucket{format_labels(bucket_labels, label_values + (bound,))} {cumulative}")
+                lines.append(f"{self.name}_bucket{format_labels(bucket_labels, label_values + ('+Inf',))} {count}")
+                lines.append(f"{self.name}_sum{format_labels(self.labels, label_values)} {total}")
+                lines.append(f"{self.name}_count{format_labels(self.labels, label_values)} {count}")
+        return lines
+
+class GaugeMetric:
+    """Valori letti al momento dell'esposizione tramite una funzione (etichette -> valore)."""
+
+    def __init__(self, name, help_text, labels, collect):
+        self.name = name
+        self.help_text = help_text
+        self.labels = labels
+        self.collect = collect
+        METRICS.append(self)
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} gauge"]
+        for label_values, value in self.collect().items():
+            lines.append(f"{self.name}{format_labels(self.labels, label_values)} {value}")
+        return lines
+
+http_request_duration = HistogramMetric(
+    "http_request_duration_seconds", "Durata delle richieste HTTP", ("route", "method", "status"))
+mongo_command_duration = HistogramMetric(
+    "mongo_command_duration_seconds", "Durata dei comandi MongoDB", ("collection", "command", "outcome"))
+airport_gap_duration = HistogramMetric(
+    "airport_gap_request_duration_seconds", "Durata delle chiamate ad Airport Gap", ("outcome",))
+upload_bytes = CounterMetric("upload_bytes_total", "Byte ricevuti tramite /upload")
+download_bytes = CounterMetric("download_bytes_total", "Byte inviati tramite /download")
+rejected_requests = CounterMetric(
+    "rejected_requests_total", "Richieste rifiutate dal controllo di ammissione", ("reason",))
+
+class MongoCommandMetrics(monitoring.CommandListener):
+    """Conta e cronometra i comandi MongoDB per collezione tramite il command monitoring di pymongo."""
+
+    def __init__(self):
+        self.pending = {}
+        self._lock = threading.Lock()
+
+    def started(self, event):
+        target = event.command.get(event.command_name)
+        collection = event.command.get("collection") if event.command_name == "getMore" else target
+        with self._lock:
+            self.pending[(event.connection_id, event.request_id)] = collection if isinstance(collection, str) else ""
+
+    def _finished(self, event, outcome):
+        with self._lock:
+            collection = self.pending.pop((event.connection_id, event.request_id), "")
+        mongo_command_duration.observe(event.duration_micros / 1e6, collection, event.command_name, outcome)
+
+    def succeeded(self, event):
+        self._finished(event, "ok")
+
+    def failed(self, event):
+        self._finished(event, "error")
+
+# Client e collezioni MongoDB: creati da init_mongo() in ogni processo, dopo l'eventuale fork
+client = None
+db = None
+users_collection = None
+client_collection = None
+memberships_collection = None
+snapshots_collection = None
+airports_collection = None
+distance_cache_collection = None
+rollups_collection = None
+jobs_collection = None
+files_collection = None
+blobs_collection = None
+storage_stats_collection = None
+rate_limits_collection = None
+upload_sessions_collection = None
+upload_chunks_collection = None
+fs = None
+
+# Opzioni del MongoClient configurabili da variabili d'ambiente (usate solo se impostate)
+MONGO_CLIENT_OPTIONS = {
+    "maxPoolSize": "MONGO_MAX_POOL_SIZE",
+    "minPoolSize": "MONGO_MIN_POOL_SIZE",
+    "maxIdleTimeMS": "MONGO_MAX_IDLE_TIME_MS",
+    "waitQueueTimeoutMS": "MONGO_WAIT_QUEUE_TIMEOUT_MS",
+    "connectTimeoutMS": "MONGO_CONNECT_TIMEOUT_MS",
+    "socketTimeoutMS": "MONGO_SOCKET_TIMEOUT_MS",
+    "serverSelectionTimeoutMS": "MONGO_SERVER_SELECTION_TIMEOUT_MS",
+}
+
+def init_mongo():
+    """Crea il client MongoDB, le collezioni e GridFS per il processo corrente."""
+    global client, db, users_collection, client_collection, memberships_collection, snapshots_collection
+    global airports_collection, distance_cache_collection
+    global rollups_collection, jobs_collection, files_collection, blobs_collection, storage_stats_collection
+    global rate_limits_collection
+    global upload_sessions_collection, upload_chunks_collection, fs
+    if client is not None:
+        return
+
+    # Stringa di connessione a MongoDB Atlas
+    mongo_uri = os.getenv("MONGO_URI")
+    if not mongo_uri:
+        raise Exception("La variabile MONGO_URI non è configurata!")
+
+    options = {option: int(os.environ[name]) for option, name in MONGO_CLIENT_OPTIONS.items() if os.getenv(name)}
+
+    # Connessione al database MongoDB Atlas
+    client = MongoClient(mongo_uri, event_listeners=[MongoCommandMetrics()], **options)
+    db = client[os.getenv("MONGO_DB_NAME", "my_database")]  # Nome del database trasferito
+    users_collection = db["users"]
+    client_collection = db["clients"]  # Un documento per cliente
+    memberships_collection = db["client_users"]  # Associazioni (cliente_id, api_key)
+    snapshots_collection = db["client_snapshots"]  # Documenti energetici, riferiti al cliente tramite cliente_id
+    airports_collection = db["airports"]
+    distance_cache_collection = db["distance_cache"]
+    rollups_collection = db["energy_rollups"]  # Totali per cliente, anno e document_type
+    jobs_collection = db["jobs"]  # Elaborazioni asincrone di /add_energy_data
+    files_collection = db["files"]  # Metadati dei file caricati
+    blobs_collection = db["file_blobs"]  # Contenuti indirizzati per SHA-256, con contatore dei riferimenti
+    storage_stats_collection = db["storage_stats"]  # Contatori dello spazio occupato, letti da /stats/storage
+    rate_limits_collection = db["rate_limits"]  # Token bucket condivisi tra i worker (RATE_LIMIT_BACKEND=mongo)
+    upload_sessions_collection = db["upload_sessions"]  # Upload a blocchi riprendibili
+    upload_chunks_collection = db["upload_chunks"]  # Blocchi ricevuti, in attesa del completamento
+    fs = gridfs.GridFS(db)  # GridFS per file grandi
+
+app_initialized = False
+app_init_lock = threading.Lock()
+
+def create_app():
+    """Factory dell'applicazione: inizializza MongoDB, gli indici e riprende i job sospesi.
+
+    Con gunicorn viene chiamata in ogni worker dopo il fork (vedi gunicorn.conf.py); è
+    idempotente, quindi può essere richiamata senza effetti.
+    """
+    global app_initialized
+    with app_init_lock:
+        if not app_initialized:
+            init_mongo()
+            ensure_indexes()
+            recover_jobs()
+            start_auth_cache_watcher()
+            app_initialized = True
+    return app
+
+@app.before_request
+def ensure_app_initialized():
+    # Con "flask --app server run" (o un server WSGI che importa direttamente server:app)
+    # create_app() non viene chiamata: l'inizializzazione avviene alla prima richiesta
+    if not app_initialized:
+        create_app()
+
+def shutdown():
+    """Arresto ordinato: attende i job in corso e chiude le connessioni."""
+    global client
+    job_executor.shutdown(wait=True)
+    airport_gap_executor.shutdown(wait=True)
+    airport_gap_session.close()
+    if client is not None:
+        client.close()
+        client = None
+
+# Esclude i file incorporati dagli utenti non ancora migrati
+USER_PROJECTION = {"files": 0}
+
+# I file che stanno in un solo chunk GridFS vengono salvati come documento, gli altri in GridFS
+INLINE_BLOB_MAX_SIZE = int(os.getenv("INLINE_BLOB_MAX_SIZE", str(gridfs.DEFAULT_CHUNK_SIZE)))
+UPLOAD_CHUNK_SIZE = 64 * 1024
+
+FILE_CATEGORIES = ["pdfs", "images", "excels"]
+
+def drop_legacy_ttl_index(collection, name):
+    """Elimina un vecchio indice TTL con durata fissa, sostituito da un campo expires_at per documento.
+
+    Le durate configurabili non stanno negli indici: cambiare expireAfterSeconds su un indice
+    esistente fa fallire create_index (IndexOptionsConflict) all'avvio.
+    """
+    if name in collection.index_information():
+        collection.drop_index(name)
+
+def ensure_indexes():
+    """Crea gli indici usati dagli endpoint (operazione idempotente)."""
+    users_collection.create_index("api_key", unique=True)
+    users_collection.create_index("email")
+    users_collection.create_index("username")
+    client_collection.create_index([("nome", 1), ("timestamp", -1)])
+    memberships_collection.create_index([("cliente_id", 1), ("api_key", 1)], unique=True)
+    memberships_collection.create_index("api_key")
+    # Ultimo documento e storico di un cliente: sort per timestamp decrescente sull'indice
+    snapshots_collection.create_index([("cliente_id", 1), ("timestamp", -1), ("_id", -1)])
+    drop_legacy_ttl_index(distance_cache_collection, "updated_at_1")
+    distance_cache_collection.create_index("expires_at", expireAfterSeconds=0)
+    files_collection.create_index([("owner_id", 1), ("file_id", 1)], unique=True)
+    files_collection.create_index([("owner_id", 1), ("category", 1), ("uploaded_at", 1)])
+    rollups_collection.create_index([("nome", 1), ("anno", 1), ("document_type", 1)], unique=True)
+    jobs_collection.create_index([("status", 1), ("created_at", 1)])
+    drop_legacy_ttl_index(jobs_collection, "finished_at_1")
+    jobs_collection.create_index("expires_at", expireAfterSeconds=0)
+    if RATE_LIMIT_BACKEND == "mongo":
+        # Un bucket inattivo il tempo di ricaricarsi è di nuovo pieno: il documento può essere eliminato
+        drop_legacy_ttl_index(rate_limits_collection, "updated_at_1")
+        rate_limits_collection.create_index("expires_at", expireAfterSeconds=0)
+    # Sessioni di upload abbandonate e relativi blocchi vengono eliminati alla scadenza
+    upload_sessions_collection.create_index("expires_at", expireAfterSeconds=0)
+    upload_chunks_collection.create_index([("session_id", 1), ("index", 1)], unique=True)
+    upload_chunks_collection.create_index("expires_at", expireAfterSeconds=0)
 
 def generate_api_key():
     """Genera una API Key univoca."""
@@ -48,14 +395,10 @@ def create_user():
     user = {
         "username": username,
         "email": email,
-        "api_key": api_key,
-        "files": {  # Inizializza la struttura dei file
-            "pdfs": [],
-            "images": [],
-            "excels": []
-        }
+        "api_key": api_key
     }
     users_collection.insert_one(user)
+    auth_cache.invalidate(api_key)
 
     return jsonify({
         "message": "Utente creato con successo",
@@ -76,27 +419,30 @@ def associate_user_to_client():
     username = data['username']
 
     # Trova il cliente
-    cliente = client_collection.find_one({"nome": nome_cliente})
+    cliente = client_collection.find_one({"nome": nome_cliente}, {"_id": 1})
     if not cliente:
         return jsonify({"error": "Cliente non trovato"}), 404
 
     # Trova l'utente tramite lo username
-    user = users_collection.find_one({"username": username})
+    user = users_collection.find_one({"username": username}, USER_PROJECTION)
     if not user:
         return jsonify({"error": "Utente non trovato"}), 404
 
     api_key = user["api_key"]  # Ottieni l'API key dell'utente
 
-    # Aggiungi l'utente alla lista dei clienti se non è già presente
-    if api_key not in cliente.get("utenti", []):
-        client_collection.update_one(
-            {"nome": nome_cliente},
-            {"$push": {"utenti": api_key}}
-        )
-        return jsonify({"message": f"Utente {username} associato al cliente {nome_cliente}"}), 200
-    else:
+    # Aggiungi l'associazione se non è già presente (indice univoco su cliente_id, api_key)
+    try:
+        memberships_collection.insert_one({
+            "cliente_id": cliente["_id"],
+            "api_key": api_key,
+            "created_at": datetime.utcnow()
+        })
+    except DuplicateKeyError:
         return jsonify({"error": f"L'utente {username} è già associato a questo cliente"}), 400
 
+    auth_cache.invalidate(api_key)
+    return jsonify({"message": f"Utente {username} associato al cliente {nome_cliente}"}), 200
+
 @app.route('/create_client', methods=['POST'])
 def create_client():
     data = request.json
@@ -110,18 +456,16 @@ def create_client():
     if existing_client:
         return jsonify({"error": "Il cliente con questo nome esiste già"}), 400
 
-    # Inizializza il cliente con una struttura vuota per i dati energetici
+    # Utenti associati e documenti energetici sono in collezioni separate
     cliente = {
         "nome": nome,
-        "utenti": [],  # Lista di utenti associati al cliente
-        "dati": [],  # Inizializzato come array
         "timestamp": datetime.utcnow()  # Timestamp corrente
     }
 
     client_collection.insert_one(cliente)
     return jsonify({
         "message": "Cliente creato con successo",
-        "cliente": {"nome": nome, "dati": cliente["dati"]}
+        "cliente": {"nome": nome, "dati": []}
     }), 201
 
 def validate_api_key(api_key):
@@ -129,27 +473,390 @@ def validate_api_key(api_key):
     if not api_key:
         return None, {"error": "API Key mancante"}, 401
 
-    user = users_collection.find_one({"api_key": api_key})
-    if not user:
+    principal = resolve_principal(api_key)
+    if not principal:
         return None, {"error": "API Key non valida"}, 401
 
-    return user, None, None
+    return principal["user"], None, None
 
 def get_associated_client(api_key):
     """Trova il cliente associato all'utente tramite l'API Key."""
-    cliente = client_collection.find_one({"utenti": api_key})
+    principal = resolve_principal(api_key)
+    cliente = principal["cliente"] if principal else None
     if not cliente:
         return None, {"error": "L'utente non è associato a nessun cliente"}, 403
 
     return cliente, None, None
 
+AIRPORT_GAP_URL = os.getenv("AIRPORT_GAP_URL", "https://airportgap.com/api/airports/distance")
+EARTH_RADIUS_KM = 6371.0088  # Raggio medio terrestre
+AIRPORTS_REFRESH_SECONDS = int(os.getenv("AIRPORTS_REFRESH_SECONDS", "86400"))
+
+class AirportTable:
+    """Tabella compatta in memoria: codice IATA -> indice in due array di coordinate (in radianti)."""
+
+    def __init__(self):
+        # (indice, latitudini, longitudini): un'unica tupla, mai modificata dopo l'assegnazione
+        self.table = ({}, array('d'), array('d'))
+        self.loaded_at = None
+
+    def load(self, airports):
+        """Carica gli aeroporti da documenti con i campi 'iata', 'latitude' e 'longitude'."""
+        index = {}
+        lat = array('d')
+        lon = array('d')
+        for airport in airports:
+            code = str(airport.get("iata") or "").strip().upper()
+            if not code or code in index:
+                continue
+            try:
+                latitude = math.radians(float(airport["latitude"]))
+                longitude = math.radians(float(airport["longitude"]))
+            except (KeyError, TypeError, ValueError):
+                continue
+            index[code] = len(lat)
+            lat.append(latitude)
+            lon.append(longitude)
+
+        # Sostituisce la tabella con una sola assegnazione, così le letture concorrenti restano coerenti
+        self.table = (index, lat, lon)
+        self.loaded_at = time.monotonic()
+        return len(index)
+
+    def distances(self, pairs):
+        """Calcola in blocco le distanze ortodromiche (km) per una lista di coppie (from, to).
+
+        Restituisce None per le coppie che contengono un codice sconosciuto.
+        """
+        index, lat, lon = self.table
+        sin, cos, asin, sqrt = math.sin, math.cos, math.asin, math.sqrt
+        diameter = 2 * EARTH_RADIUS_KM
+
+        result = []
+        for from_code, to_code in pairs:
+            i = index.get(str(from_code).strip().upper())
+            j = index.get(str(to_code).strip().upper())
+            if i is None or j is None:
+                result.append(None)
+                continue
+            lat_i, lat_j = lat[i], lat[j]
+            h = sin((lat_j - lat_i) / 2) ** 2 + cos(lat_i) * cos(lat_j) * sin((lon[j] - lon[i]) / 2) ** 2
+            result.append(diameter * asin(min(1.0, sqrt(h))))
+        return result
+
+airport_table = AirportTable()
+airport_table_lock = threading.Lock()
+
+def ensure_airport_table():
+    """Carica (o ricarica periodicamente) la tabella degli aeroporti da airports_collection."""
+    loaded_at = airport_table.loaded_at
+    if loaded_at is not None and time.monotonic() - loaded_at < AIRPORTS_REFRESH_SECONDS:
+        return airport_table
+
+    with airport_table_lock:
+        if airport_table.loaded_at == loaded_at:
+            try:
+                count = airport_table.load(airports_collection.find(
+                    {}, {"_id": 0, "iata": 1, "latitude": 1, "longitude": 1}
+                ))
+                print(f"Tabella aeroporti caricata: {count} codici IATA")
+            except Exception as e:
+                # Mantiene la tabella precedente e riprova al prossimo intervallo
+                airport_table.loaded_at = time.monotonic()
+                print(f"Errore durante il caricamento degli aeroporti: {str(e)}")
+    return airport_table
+
+class LRUCache:
+    """Cache LRU in memoria, limitata in dimensione, con scadenza (TTL) e contatori di hit/miss."""
+
+    def __init__(self, maxsize, ttl):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is not None:
+                value, expires_at = entry
+                if expires_at > time.monotonic():
+                    self._data.move_to_end(key)
+                    self.hits += 1
+                    return value
+                del self._data[key]
+            self.misses += 1
+            return default
+
+    def set(self, key, value):
+        with self._lock:
+            self._data[key] = (value, time.monotonic() + self.ttl)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def invalidate(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
+
+AUTH_CACHE_SIZE = int(os.getenv("AUTH_CACHE_SIZE", "10000"))
+AUTH_CACHE_TTL = int(os.getenv("AUTH_CACHE_TTL", "60"))  # Limite di staleness se le change stream non sono disponibili
+AUTH_CACHE_WATCH = os.getenv("AUTH_CACHE_WATCH", "1") == "1"
+
+# API Key -> {"user": utente ridotto, "cliente": cliente associato ridotto oppure None}
+auth_cache = LRUCache(AUTH_CACHE_SIZE, AUTH_CACHE_TTL)
+AUTH_USER_PROJECTION = {"username": 1, "email": 1, "api_key": 1}
+AUTH_CLIENT_PROJECTION = {"nome": 1, "timestamp": 1}
+
+def resolve_principal(api_key):
+    """Risolve l'API Key nell'utente e nel cliente associato, passando dalla cache in memoria."""
+    principal = auth_cache.get(api_key)
+    if principal is not None:
+        return principal
+
+    user = users_collection.find_one({"api_key": api_key}, AUTH_USER_PROJECTION)
+    if not user:
+        # Le chiavi non valide non vengono messe in cache
+        return None
+    cliente = None
+    membership = memberships_collection.find_one({"api_key": api_key}, {"cliente_id": 1})
+    if membership:
+        cliente = client_collection.find_one({"_id": membership["cliente_id"]}, AUTH_CLIENT_PROJECTION)
+    principal = {"user": user, "cliente": cliente}
+    auth_cache.set(api_key, principal)
+    return principal
+
+def watch_auth_changes():
+    """Svuota la cache delle API Key quando un altro processo modifica utenti o associazioni ai clienti."""
+    pipeline = [{"$match": {"$or": [
+        {
+            "ns.coll": {"$in": [users_collection.name, client_collection.name]},
+            "operationType": {"$in": ["update", "replace", "delete", "drop", "rename", "dropDatabase", "invalidate"]}
+        },
+        # Anche le nuove associazioni: un altro worker può avere in cache l'utente senza cliente
+        {"ns.coll": memberships_collection.name}
+    ]}}]
+    resume_token = None
+    while True:
+        try:
+            with db.watch(pipeline, resume_after=resume_token) as stream:
+                for change in stream:
+                    resume_token = stream.resume_token
+                    auth_cache.clear()
+        except OperationFailure as e:
+            # Es. server standalone senza replica set: resta valido solo il TTL
+            print(f"Change stream non disponibili, cache API Key limitata dal TTL: {str(e)}")
+            return
+        except PyMongoError as e:
+            print(f"Errore nella change stream della cache API Key: {str(e)}")
+            time.sleep(5)
+        # Eventuali modifiche perse durante l'interruzione
+        auth_cache.clear()
+
+def start_auth_cache_watcher():
+    if AUTH_CACHE_WATCH:
+        threading.Thread(target=watch_auth_changes, name="auth-cache-watcher", daemon=True).start()
+
+DISTANCE_CACHE_SIZE = int(os.getenv("DISTANCE_CACHE_SIZE", "10000"))
+DISTANCE_CACHE_TTL = int(os.getenv("DISTANCE_CACHE_TTL", str(30 * 24 * 3600)))  # 30 giorni
+
+distance_lru = LRUCache(DISTANCE_CACHE_SIZE, DISTANCE_CACHE_TTL)
+distance_cache_counters = {"mongo_hits": 0, "mongo_misses": 0, "mongo_errors": 0}
+distance_cache_counters_lock = threading.Lock()
+
+def count_distance_cache(event):
+    # Chiamata in parallelo dai thread del pool di Airport Gap: "+= 1" su un dict non è atomico
+    with distance_cache_counters_lock:
+        distance_cache_counters[event] += 1
+
+def route_key(from_code, to_code):
+    """Chiave della tratta come coppia non ordinata: MXP->FCO e FCO->MXP condividono la stessa voce."""
+    return "|".join(sorted((str(from_code).strip().upper(), str(to_code).strip().upper())))
+
+def get_cached_distance(from_code, to_code):
+    """Restituisce la distanza tra due aeroporti passando per la cache LRU, poi MongoDB, poi l'API."""
+    key = route_key(from_code, to_code)
+    distance = distance_lru.get(key)
+    if distance is not None:
+        return distance
+
+    try:
+        cached = distance_cache_collection.find_one({
+            "_id": key,
+            # L'indice TTL elimina i documenti con ritardo: filtra comunque quelli scaduti
+            "expires_at": {"$gt": datetime.utcnow()}
+        })
+    except Exception as e:
+        print(f"Errore durante la lettura della cache distanze: {str(e)}")
+        count_distance_cache("mongo_errors")
+        cached = None
+
+    if cached:
+        count_distance_cache("mongo_hits")
+        distance_lru.set(key, cached["kilometers"])
+        return cached["kilometers"]
+    count_distance_cache("mongo_misses")
+
+    distance = get_distance_with_api(from_code, to_code)
+    distance_lru.set(key, distance)
+    try:
+        now = datetime.utcnow()
+        distance_cache_collection.update_one(
+            {"_id": key},
+            {"$set": {"kilometers": distance, "updated_at": now,
+                      "expires_at": now + timedelta(seconds=DISTANCE_CACHE_TTL)}},
+            upsert=True
+        )
+    except Exception as e:
+        print(f"Errore durante il salvataggio nella cache distanze: {str(e)}")
+        count_distance_cache("mongo_errors")
+    return distance
+
+def get_distance_cache_stats():
+    """Statistiche della cache delle distanze (entrambi i livelli)."""
+    with distance_cache_counters_lock:
+        counters = dict(distance_cache_counters)
+    return {
+        "lru_size": len(distance_lru),
+        "lru_hits": distance_lru.hits,
+        "lru_misses": distance_lru.misses,
+        **counters,
+        "negative_size": len(distance_failures),
+        "negative_hits": distance_failures.hits,
+        "circuit_open": int(airport_gap_breaker.is_open()),
+        "circuit_rejected": airport_gap_breaker.rejected
+    }
+
+AIRPORT_GAP_MAX_WORKERS = int(os.getenv("AIRPORT_GAP_MAX_WORKERS", "8"))
+
+# Sessione condivisa con connessioni keep-alive verso Airport Gap
+airport_gap_session = requests.Session()
+airport_gap_session.mount("https://", requests.adapters.HTTPAdapter(pool_maxsize=AIRPORT_GAP_MAX_WORKERS))
+airport_gap_session.mount("http://", requests.adapters.HTTPAdapter(pool_maxsize=AIRPORT_GAP_MAX_WORKERS))
+airport_gap_executor = ThreadPoolExecutor(max_workers=AIRPORT_GAP_MAX_WORKERS, thread_name_prefix="airport-gap")
+
+# Timeout (connessione, lettura) in secondi e tentativi aggiuntivi con backoff esponenziale e jitter
+AIRPORT_GAP_TIMEOUT = (
+    float(os.getenv("AIRPORT_GAP_CONNECT_TIMEOUT", "3.05")),
+    float(os.getenv("AIRPORT_GAP_READ_TIMEOUT", "10"))
+)
+AIRPORT_GAP_RETRIES = int(os.getenv("AIRPORT_GAP_RETRIES", "2"))
+AIRPORT_GAP_BACKOFF = float(os.getenv("AIRPORT_GAP_BACKOFF", "0.2"))
+AIRPORT_GAP_BACKOFF_MAX = float(os.getenv("AIRPORT_GAP_BACKOFF_MAX", "2"))
+AIRPORT_GAP_BREAKER_THRESHOLD = int(os.getenv("AIRPORT_GAP_BREAKER_THRESHOLD", "5"))
+AIRPORT_GAP_BREAKER_COOLDOWN = float(os.getenv("AIRPORT_GAP_BREAKER_COOLDOWN", "30"))
+AIRPORT_GAP_NEGATIVE_TTL = int(os.getenv("AIRPORT_GAP_NEGATIVE_TTL", "600"))
+AIRPORT_GAP_RETRY_AFTER_MAX = float(os.getenv("AIRPORT_GAP_RETRY_AFTER_MAX", "5"))  # Attesa massima accettata da un 429
+
+class CircuitBreaker:
+    """Interruttore per un servizio esterno: dopo `threshold` errori consecutivi rifiuta le chiamate
+    per `cooldown` secondi, poi lascia passare una sola chiamata di prova (half-open)."""
+
+    def __init__(self, threshold, cooldown):
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.failures = 0
+        self.opened_at = None
+        self.probing = False
+        self.rejected = 0
+        self._lock = threading.Lock()
+
+    def is_open(self):
+        return self.opened_at is not None
+
+    def allow(self):
+        with self._lock:
+            if self.opened_at is None:
+                return True
+            if not self.probing and time.monotonic() - self.opened_at >= self.cooldown:
+                self.probing = True
+                return True
+            self.rejected += 1
+            return False
+
+    def record_success(self):
+        with self._lock:
+            self.failures = 0
+            self.opened_at = None
+            self.probing = False
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            if self.probing or self.failures >= self.threshold:
+                if self.opened_at is None:
+                    print(f"Circuito Airport Gap aperto dopo {self.failures} errori consecutivi")
+                self.opened_at = time.monotonic()
+                self.probing = False
+
+airport_gap_breaker = CircuitBreaker(AIRPORT_GAP_BREAKER_THRESHOLD, AIRPORT_GAP_BREAKER_COOLDOWN)
+# Tratte rifiutate dall'API (es. codice IATA inesistente): non vengono richieste di nuovo fino alla scadenza
+distance_failures = LRUCache(DISTANCE_CACHE_SIZE, AIRPORT_GAP_NEGATIVE_TTL)
+
+class AirportGapError(Exception):
+    """Errore definitivo dell'API Airport Gap per una tratta (non viene ritentato)."""
+
+def retry_after_seconds(response):
+    """Secondi indicati dall'header Retry-After (numero o data HTTP), None se assente o non valido."""
+    value = response.headers.get("Retry-After")
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        retry_at = parse_date(value)
+        return max(0.0, (retry_at - datetime.now(timezone.utc)).total_seconds()) if retry_at else None
+
+def resolve_remote_distances(pairs):
+    """Risolve in parallelo le tratte distinte (coppie non ordinate) tramite cache/API.
+
+    Restituisce un dizionario route_key -> distanza in km oppure l'eccezione sollevata.
+    """
+    unique_routes = {}
+    for from_code, to_code in pairs:
+        unique_routes.setdefault(route_key(from_code, to_code), (from_code, to_code))
+
+    def resolve(route):
+        try:
+            return get_cached_distance(*route)
+        except Exception as e:
+            return e
+
+    if len(unique_routes) == 1:
+        return {key: resolve(route) for key, route in unique_routes.items()}
+    return dict(zip(unique_routes, airport_gap_executor.map(resolve, unique_routes.values())))
+
+def get_flight_distances(pairs):
+    """Calcola le distanze di tutte le tratte di una richiesta.
+
+    Usa la tabella locale in blocco e ricorre alla cache/API Airport Gap solo per i codici
+    sconosciuti, con una sola chiamata (in parallelo alle altre) per ogni tratta distinta.
+    Restituisce una lista allineata a pairs con la distanza in km oppure l'eccezione sollevata.
+    """
+    distances = ensure_airport_table().distances(pairs)
+    missing = [position for position, distance in enumerate(distances) if distance is None]
+    if missing:
+        resolved = resolve_remote_distances([pairs[position] for position in missing])
+        for position in missing:
+            distances[position] = resolved[route_key(*pairs[position])]
+    return distances
+
 def get_distance_with_api(from_code, to_code):
     """Calcola la distanza tra due aeroporti utilizzando l'API Airport Gap."""
     api_key = os.getenv("AIRPORT_GAP_API_KEY")  # Assicurati che la tua chiave API sia configurata come variabile d'ambiente
     if not api_key:
         raise Exception("API Key per Airport Gap non configurata")
 
-    url = "https://airportgap.com/api/airports/distance"
+    url = AIRPORT_GAP_URL
     headers = {
         "Authorization": f"Bearer {api_key}",
         "Content-Type": "application/json"
@@ -159,29 +866,81 @@ def get_distance_with_api(from_code, to_code):
         "to": to_code
     }
 
-    try:
-        response = requests.post(url, json=payload, headers=headers)
-        if response.status_code == 200:
-            data = response.json()
-            # Restituisce la distanza in chilometri
-            return data["data"]["attributes"]["kilometers"]
-        else:
+    key = route_key(from_code, to_code)
+    failure = distance_failures.get(key)
+    if failure is not None:
+        raise AirportGapError(failure)
+
+    delay = None  # Attesa imposta da Retry-After prima del tentativo successivo
+    for attempt in range(AIRPORT_GAP_RETRIES + 1):
+        if attempt:
+            if delay is None:
+                # Full jitter: attesa casuale fino al backoff esponenziale
+                delay = random.uniform(0, min(AIRPORT_GAP_BACKOFF_MAX, AIRPORT_GAP_BACKOFF * 2 ** (attempt - 1)))
+            time.sleep(delay)
+            delay = None
+        if not airport_gap_breaker.allow():
+            airport_gap_duration.observe(0, "rejected")
+            raise Exception("API Airport Gap non disponibile (circuito aperto)")
+
+        start = time.perf_counter()
+        outcome = "error"
+        try:
+            response = airport_gap_session.post(url, json=payload, headers=headers, timeout=AIRPORT_GAP_TIMEOUT)
+            if response.status_code == 200:
+                data = response.json()
+                outcome = "ok"
+                airport_gap_breaker.record_success()
+                # Restituisce la distanza in chilometri
+                return data["data"]["attributes"]["kilometers"]
             print(f"Errore API: {response.status_code} - {response.text}")
-            raise Exception("Impossibile calcolare la distanza tramite l'API Airport Gap")
-    except Exception as e:
-        print(f"Errore durante la chiamata all'API: {str(e)}")
-        raise
+            message = f"Impossibile calcolare la distanza tramite l'API Airport Gap ({response.status_code})"
+            if response.status_code == 429:
+                # Limite di richieste: il servizio è attivo, non è un guasto per il circuito
+                outcome = "throttled"
+                airport_gap_breaker.record_success()
+                delay = retry_after_seconds(response)
+                if delay is not None and delay > AIRPORT_GAP_RETRY_AFTER_MAX:
+                    raise Exception(message)
+                continue
+            if response.status_code in (404, 422):
+                # Il servizio risponde ma rifiuta la tratta (es. codice IATA inesistente): inutile ritentare
+                outcome = "rejected_route"
+                airport_gap_breaker.record_success()
+                distance_failures.set(key, message)
+                raise AirportGapError(message)
+            if response.status_code in (401, 403):
+                # API Key mancante o revocata: vale per tutte le tratte, il circuito deve potersi aprire
+                airport_gap_breaker.record_failure()
+                raise Exception(message)
+            if response.status_code < 500:
+                airport_gap_breaker.record_success()
+                raise Exception(message)
+        except (requests.RequestException, ValueError, KeyError, TypeError) as e:
+            print(f"Errore durante la chiamata all'API: {str(e)}")
+        finally:
+            airport_gap_duration.observe(time.perf_counter() - start, outcome)
+        airport_gap_breaker.record_failure()
+
+    raise Exception("Impossibile calcolare la distanza tramite l'API Airport Gap")
 
 def get_and_validate_request_data():
     """Recupera e valida i dati della richiesta."""
     data = request.json
+    anno, error, status_code = validate_energy_data(data)
+    if error:
+        return None, None, error, status_code
+    return data, anno, None, None
+
+def validate_energy_data(data):
+    """Valida un documento energetico e restituisce l'anno richiesto."""
     if not data or not isinstance(data, dict) or 'anno' not in data or 'dati' not in data:
-        return None, None, {"error": "Formato dati non valido."}, 400
+        return None, {"error": "Formato dati non valido."}, 400
     try:
         anno = int(data['anno'])
     except ValueError:
-        return None, None, {"error": "Anno non valido. Deve essere un numero intero"}, 400
-    return data, anno, None, None
+        return None, {"error": "Anno non valido. Deve essere un numero intero"}, 400
+    return anno, None, None
 
 def process_flight_items_with_notes(items, anno):
     """Processa i dati relativi ai voli e calcola l'impatto per l'anno specificato."""
@@ -189,27 +948,40 @@ def process_flight_items_with_notes(items, anno):
     total_flight_impact = 0
     discarded_files = []
 
+    # Prima passata: seleziona i voli dell'anno e raccoglie le tratte (None = da scartare)
+    legs = []
     for item in items:
         # Controlla se il campo 'date' è presente e non vuoto
         if 'date' not in item or not item['date']:
-            discarded_files.append(item['document_name'])
+            legs.append((item, None))
             continue
 
         try:
             # Controlla se la data appartiene all'anno specificato
             flight_date = datetime.strptime(item['date'], "%Y-%m-%d")
         except ValueError:
-            discarded_files.append(item['document_name'])
+            legs.append((item, None))
             continue
 
         if flight_date.year != anno:
             continue
 
-        # Calcola la distanza utilizzando l'API esterna
         try:
-            distance = get_distance_with_api(item['travel']['from'], item['travel']['to'])
-        except Exception as e:
-            print(f"Errore: {str(e)}")
+            legs.append((item, (item['travel']['from'], item['travel']['to'])))
+        except (KeyError, TypeError):
+            legs.append((item, None))
+
+    # Calcola le distanze di tutte le tratte in blocco
+    distances = iter(get_flight_distances([route for _, route in legs if route is not None]))
+
+    for item, route in legs:
+        if route is None:
+            discarded_files.append(item['document_name'])
+            continue
+
+        distance = next(distances)
+        if isinstance(distance, Exception):
+            print(f"Errore: {str(distance)}")
             discarded_files.append(item['document_name'])
             continue
 
@@ -231,6 +1003,9 @@ def process_flight_items_with_notes(items, anno):
 
 def process_gas_items_with_notes(items, anno):
     """Processa i dati relativi al gas e restituisce i documenti scartati."""
+    if len(items) >= COLUMNAR_MIN_ITEMS:
+        return process_gas_items_columnar(items, anno)
+
     valid_data = []
     total_gas = 0
     discarded_files = []
@@ -256,6 +1031,9 @@ def process_gas_items_with_notes(items, anno):
 
 def process_electricity_items_with_notes(items, anno):
     """Processa i dati relativi all'elettricità e restituisce i documenti scartati."""
+    if len(items) >= COLUMNAR_MIN_ITEMS:
+        return process_electricity_items_columnar(items, anno)
+
     valid_data = []
     total_electricity = 0
     discarded_files = []
@@ -284,6 +1062,123 @@ def process_electricity_items_with_notes(items, anno):
 
     return valid_data, (round(total_electricity, 2)) , discarded_files
 
+# Sopra questa soglia gas ed elettricità usano l'elaborazione colonnare
+COLUMNAR_MIN_ITEMS = int(os.getenv("COLUMNAR_MIN_ITEMS", "1000"))
+
+def period_columns(items):
+    """Estrae in colonne le date dei periodi (None per i periodi mancanti o incompleti).
+
+    La terza colonna contiene l'eccezione sollevata dal controllo del periodo (es. period non è
+    un dizionario), da rilanciare nell'ordine degli elementi come farebbe la versione per righe.
+    """
+    start_dates = []
+    end_dates = []
+    errors = []
+    for item in items:
+        try:
+            missing = ('period' not in item or
+                'start_date' not in item['period'] or not item['period']['start_date'] or
+                'end_date' not in item['period'] or not item['period']['end_date'])
+        except Exception as e:
+            start_dates.append(None)
+            end_dates.append(None)
+            errors.append(e)
+            continue
+        errors.append(None)
+        if missing:
+            start_dates.append(None)
+            end_dates.append(None)
+        else:
+            start_dates.append(item['period']['start_date'])
+            end_dates.append(item['period']['end_date'])
+    return start_dates, end_dates, errors
+
+def parse_date_year(value):
+    """Anno di una data "%Y-%m-%d", oppure l'eccezione (ValueError o TypeError) che strptime solleverebbe."""
+    # Formato canonico YYYY-MM-DD: date.fromisoformat è molto più veloce di strptime
+    if (isinstance(value, str) and len(value) == 10 and value[4] == '-' and value[7] == '-' and
+            value.isascii() and value[:4].isdigit() and value[5:7].isdigit() and value[8:].isdigit()):
+        try:
+            return date.fromisoformat(value).year
+        except ValueError:
+            pass
+    try:
+        return datetime.strptime(value, "%Y-%m-%d").year
+    except (TypeError, ValueError) as e:
+        return e
+
+def parse_date_years(values):
+    """Converte una colonna di date nei rispettivi anni analizzando una sola volta ogni data distinta."""
+    parsed = {None: None}
+    years = []
+    for value in values:
+        try:
+            year = parsed.get(value)
+        except TypeError:
+            # Valore non hashable (es. una lista): strptime solleverà comunque TypeError
+            years.append(parse_date_year(value))
+            continue
+        if year is None and value is not None:
+            year = parsed[value] = parse_date_year(value)
+        years.append(year)
+    return years
+
+def process_gas_items_columnar(items, anno):
+    """Versione colonnare di process_gas_items_with_notes, con gli stessi risultati ed eccezioni."""
+    start_dates, end_dates, errors = period_columns(items)
+    start_years = parse_date_years(start_dates)
+    end_years = parse_date_years(end_dates)
+
+    valid_data = []
+    total_gas = 0
+    discarded_files = []
+    for item, start_year, end_year, error in zip(items, start_years, end_years, errors):
+        if error:
+            raise error
+        if start_year is None:
+            discarded_files.append(item['document_name'])
+            continue
+        # Come strptime nella versione per righe, una data non valida interrompe l'elaborazione
+        if isinstance(start_year, Exception):
+            raise start_year
+        if isinstance(end_year, Exception):
+            raise end_year
+        if start_year == anno and end_year == anno:
+            valid_data.append(item)
+            # Somma sequenziale nell'ordine degli elementi (non sum(), che compensa gli arrotondamenti)
+            total_gas += item['consumption_sMc']['value']
+
+    return valid_data, (round(total_gas, 2)), discarded_files
+
+def process_electricity_items_columnar(items, anno):
+    """Versione colonnare di process_electricity_items_with_notes, con gli stessi risultati ed eccezioni."""
+    start_dates, end_dates, errors = period_columns(items)
+    start_years = parse_date_years(start_dates)
+    end_years = parse_date_years(end_dates)
+
+    valid_data = []
+    total_electricity = 0
+    discarded_files = []
+    for item, start_year, end_year, error in zip(items, start_years, end_years, errors):
+        if error:
+            raise error
+        # La versione per righe scarta solo le date con ValueError: gli altri errori si propagano
+        if start_year is None or isinstance(start_year, ValueError):
+            discarded_files.append(item['document_name'])
+            continue
+        if isinstance(start_year, Exception):
+            raise start_year
+        if isinstance(end_year, ValueError):
+            discarded_files.append(item['document_name'])
+            continue
+        if isinstance(end_year, Exception):
+            raise end_year
+        if start_year == anno or end_year == anno:
+            valid_data.append(item)
+            total_electricity += item['total_electricity_consumption']['value']
+
+    return valid_data, (round(total_electricity, 2)), discarded_files
+
 @app.route('/add_energy_data', methods=['POST'])
 def add_energy_data():
     api_key = request.headers.get("X-API-KEY")
@@ -303,14 +1198,174 @@ def add_energy_data():
     if error:
         return jsonify(error), status_code
 
-    # Genera il timestamp corrente
-    timestamp = datetime.utcnow()
+    # Modalità asincrona: risponde subito con l'id del job
+    if request.args.get('async') in ('1', 'true') or 'respond-async' in request.headers.get('Prefer', ''):
+        if str(data.get('document_type', '')).upper() not in ROLLUP_TYPES:
+            return jsonify({"error": "Tipo di documento non supportato"}), 400
+        return submit_energy_job(user, cliente, data)
+
+    response, nuovo_documento, error, status_code = process_energy_data(cliente, user, data, anno, datetime.utcnow())
+    if error:
+        return jsonify(error), status_code
+
+    save_energy_document(cliente, anno, response, nuovo_documento)
+
+    return jsonify(response), 201
+
+
+def save_energy_document(cliente, anno, response, nuovo_documento):
+    """Salva il nuovo documento del cliente e aggiorna i rollup."""
+    # Inserisci il nuovo documento nella collezione degli snapshot
+    snapshots_collection.insert_one(nuovo_documento)
+
+    # Aggiorna i totali aggregati del cliente per anno e tipo
+    rollups_collection.update_one(
+        *rollup_update(cliente["nome"], anno, nuovo_documento["document_type"], response["value"], nuovo_documento),
+        upsert=True
+    )
+
+
+JOB_WORKERS = int(os.getenv("JOB_WORKERS", "4"))
+JOB_QUEUE_MAX = int(os.getenv("JOB_QUEUE_MAX", "32"))  # Job in coda o in esecuzione per processo
+JOB_STALE_SECONDS = int(os.getenv("JOB_STALE_SECONDS", "600"))  # Job "running" senza heartbeat da più tempo: worker morto
+JOB_HEARTBEAT_SECONDS = max(1, min(30, JOB_STALE_SECONDS // 3))
+JOBS_TTL = int(os.getenv("JOBS_TTL", str(7 * 24 * 3600)))  # I job conclusi restano consultabili 7 giorni
+
+job_executor = ThreadPoolExecutor(max_workers=JOB_WORKERS, thread_name_prefix="energy-job")
+job_slots = threading.BoundedSemaphore(JOB_QUEUE_MAX)
+
+def job_worker_id():
+    # Letto a ogni presa in carico: con preload_app il modulo è importato nel master prima del fork
+    return f"{socket.gethostname()}-{os.getpid()}"
+
+def submit_energy_job(user, cliente, data):
+    """Registra il job su MongoDB e lo accoda al pool, rifiutandolo se la coda è piena."""
+    if not job_slots.acquire(blocking=False):
+        response = jsonify({"error": "Troppi job in elaborazione, riprovare più tardi"})
+        response.headers["Retry-After"] = "5"
+        return response, 503
+
+    try:
+        now = datetime.utcnow()
+        job_id = jobs_collection.insert_one({
+            "status": "queued",
+            "user_id": user["_id"],
+            "cliente_id": cliente["_id"],
+            "data": data,
+            "created_at": now,
+            "updated_at": now
+        }).inserted_id
+        job_executor.submit(run_energy_job, job_id)
+    except Exception:
+        job_slots.release()
+        raise
+
+    return jsonify({"job_id": str(job_id), "status": "queued", "status_url": f"/jobs/{job_id}"}), 202
+
+def job_heartbeat(job_id, worker, stop):
+    """Rinnova updated_at finché il job è in esecuzione su questo worker (lease)."""
+    while not stop.wait(JOB_HEARTBEAT_SECONDS):
+        try:
+            jobs_collection.update_one(
+                {"_id": job_id, "status": "running", "worker": worker},
+                {"$set": {"updated_at": datetime.utcnow()}}
+            )
+        except PyMongoError as e:
+            print(f"Errore durante l'heartbeat del job {job_id}: {str(e)}")
+
+def run_energy_job(job_id):
+    """Esegue un job: stessa elaborazione e stesso salvataggio della chiamata sincrona."""
+    try:
+        now = datetime.utcnow()
+        worker = job_worker_id()
+        # Prende in carico il job solo se nessun altro worker lo ha già fatto
+        job = jobs_collection.find_one_and_update(
+            {"_id": job_id, "status": "queued"},
+            {"$set": {"status": "running", "worker": worker, "started_at": now, "updated_at": now}}
+        )
+        if not job:
+            return
+
+        heartbeat_stop = threading.Event()
+        threading.Thread(target=job_heartbeat, args=(job_id, worker, heartbeat_stop), daemon=True).start()
+        try:
+            user = users_collection.find_one({"_id": job["user_id"]}, USER_PROJECTION)
+            cliente = client_collection.find_one({"_id": job["cliente_id"]}, AUTH_CLIENT_PROJECTION)
+            anno, error, status_code = validate_energy_data(job["data"])
+            if not error:
+                response, nuovo_documento, error, status_code = process_energy_data(
+                    cliente, user, job["data"], anno, datetime.utcnow()
+                )
+            if error:
+                result, status_code, status = error, status_code, "failed"
+            else:
+                save_energy_document(cliente, anno, response, nuovo_documento)
+                result, status_code, status = response, 201, "done"
+        except Exception as e:
+            print(f"Errore durante l'elaborazione del job {job_id}: {str(e)}")
+            result, status_code, status = {"error": f"Errore durante l'elaborazione: {str(e)}"}, 500, "failed"
+        finally:
+            heartbeat_stop.set()
+
+        now = datetime.utcnow()
+        jobs_collection.update_one(
+            {"_id": job_id},
+            {"$set": {"status": status, "result": result, "status_code": status_code,
+                      "finished_at": now, "updated_at": now, "expires_at": now + timedelta(seconds=JOBS_TTL)},
+             "$unset": {"data": ""}}
+        )
+    finally:
+        job_slots.release()
+
+def recover_jobs():
+    """Riaccoda i job rimasti in sospeso dopo un riavvio.
+
+    Un job "running" viene ripreso solo se il suo heartbeat (updated_at) è fermo da più di
+    JOB_STALE_SECONDS: i job lunghi ancora in esecuzione su un altro worker non vengono duplicati.
+    """
+    stale = datetime.utcnow() - timedelta(seconds=JOB_STALE_SECONDS)
+    jobs_collection.update_many(
+        {"status": "running", "updated_at": {"$lt": stale}},
+        {"$set": {"status": "queued", "updated_at": datetime.utcnow()}}
+    )
+    recovered = 0
+    for job in jobs_collection.find({"status": "queued"}, {"_id": 1}).sort("created_at", 1):
+        if not job_slots.acquire(blocking=False):
+            break
+        job_executor.submit(run_energy_job, job["_id"])
+        recovered += 1
+    if recovered:
+        print(f"Job ripresi dopo il riavvio: {recovered}")
+
+@app.route('/jobs/<job_id>', methods=['GET'])
+def get_job(job_id):
+    api_key = request.headers.get("X-API-KEY")
+    user, error, status_code = validate_api_key(api_key)
+    if error:
+        return jsonify(error), status_code
+
+    job = None
+    if ObjectId.is_valid(job_id):
+        job = jobs_collection.find_one({"_id": ObjectId(job_id), "user_id": user["_id"]}, {"data": 0})
+    if not job:
+        return jsonify({"error": "Job non trovato"}), 404
 
+    # A job concluso restituisce la stessa risposta della chiamata sincrona
+    if job["status"] in ("done", "failed"):
+        return jsonify(job["result"]), job["status_code"]
+    return jsonify({"job_id": job_id, "status": job["status"]}), 202
+
+
+def process_energy_data(cliente, user, data, anno, timestamp):
+    """Processa i dati in base al document_type.
+
+    Restituisce la risposta per il client e il nuovo documento da inserire (non ancora salvato).
+    """
     # Variabili per i risultati
     discarded_files = []
 
     # Processa i dati in base al document_type
-    document_type = data.get('document_type', '').upper()
+    document_type = str(data.get('document_type', '')).upper()
     if document_type == 'BUSINESS_TRAVEL':
         flight_data, total_flight_impact, flight_discarded = process_flight_items_with_notes(data['dati'], anno)
         discarded_files.extend(flight_discarded)
@@ -342,29 +1397,121 @@ def add_energy_data():
             "note": "Date extraction failed: " + ", ".join(electricity_discarded) if electricity_discarded else None
         }
     else:
-        return jsonify({"error": "Tipo di documento non supportato"}), 400
+        return None, None, {"error": "Tipo di documento non supportato"}, 400
 
     # Prepara il nuovo documento per il cliente
     nuovo_documento = create_client_document(
         cliente, timestamp, user,
         flight_data if document_type == 'BUSINESS_TRAVEL' else [],
         electricity_data if document_type == 'ELECTRICITY' else [],
-        gas_data if document_type == 'GAS' else []
+        gas_data if document_type == 'GAS' else [],
+        anno, document_type
     )
+    return response, nuovo_documento, None, None
 
-    # Inserisci il nuovo documento nella collezione `client`
-    client_collection.insert_one(nuovo_documento)
 
-    return jsonify(response), 201
+BULK_BATCH_SIZE = int(os.getenv("BULK_BATCH_SIZE", "500"))
+
+@app.route('/add_energy_data/bulk', methods=['POST'])
+def add_energy_data_bulk():
+    """Importa documenti energetici da un corpo NDJSON (un documento per riga).
 
+    Le righe vengono lette ed elaborate una alla volta e salvate a blocchi; il risultato di
+    ogni riga viene restituito in streaming come NDJSON, seguito da un riepilogo finale.
+    """
+    api_key = request.headers.get("X-API-KEY")
+
+    # Valida l'API Key
+    user, error, status_code = validate_api_key(api_key)
+    if error:
+        return jsonify(error), status_code
 
-def create_client_document(cliente, timestamp, user, flight_data, electricity_data, gas_data):
+    # Trova il cliente associato
+    cliente, error, status_code = get_associated_client(api_key)
+    if error:
+        return jsonify(error), status_code
+
+    def generate():
+        summary = {"records": 0, "inserted": 0, "errors": 0}
+        pending = []  # (risultato della riga, documento da inserire oppure None)
+
+        def flush():
+            # Un solo insert_many e un solo bulk_write dei rollup per blocco
+            inserts = [(result, documento) for result, documento in pending if documento is not None]
+            failed = {}  # Posizione in inserts -> messaggio di errore
+            try:
+                if inserts:
+                    snapshots_collection.insert_many([documento for _, documento in inserts], ordered=False)
+            except BulkWriteError as e:
+                # ordered=False: gli altri documenti del blocco sono stati comunque inseriti
+                failed = {error["index"]: error.get("errmsg", "errore di scrittura") for error in e.details["writeErrors"]}
+            except PyMongoError as e:
+                failed = dict.fromkeys(range(len(inserts)), str(e))
+
+            for index, message in failed.items():
+                result, _ = inserts[index]
+                line_number = result["line"]
+                result.clear()
+                result.update({"line": line_number, "status": 500, "error": f"Salvataggio non riuscito: {message}"})
+                summary["errors"] += 1
+            inserted = [(result, documento) for index, (result, documento) in enumerate(inserts) if index not in failed]
+
+            # I rollup vanno incrementati solo per i documenti effettivamente salvati
+            if inserted:
+                try:
+                    rollups_collection.bulk_write([
+                        UpdateOne(
+                            *rollup_update(cliente["nome"], documento["anno"], documento["document_type"], result["value"], documento),
+                            upsert=True
+                        )
+                        for result, documento in inserted
+                    ], ordered=False)
+                except PyMongoError as e:
+                    # I documenti sono salvati: i totali si riallineano con "flask rebuild-rollups"
+                    print(f"Errore nell'aggiornamento dei rollup del cliente {cliente['nome']}: {str(e)}")
+                summary["inserted"] += len(inserted)
+            lines = "".join(app.json.dumps(result) + "\n" for result, _ in pending)
+            pending.clear()
+            return lines
+
+        for line_number, line in enumerate(request.stream, start=1):
+            if not line.strip():
+                continue
+            summary["records"] += 1
+            try:
+                data = app.json.loads(line)
+                anno, error, status_code = validate_energy_data(data)
+                if not error:
+                    response, nuovo_documento, error, status_code = process_energy_data(
+                        cliente, user, data, anno, datetime.utcnow()
+                    )
+            except Exception as e:
+                error, status_code = {"error": f"Record non valido: {str(e)}"}, 400
+
+            if error:
+                summary["errors"] += 1
+                pending.append(({"line": line_number, "status": status_code, **error}, None))
+            else:
+                pending.append(({"line": line_number, "status": 201, **response}, nuovo_documento))
+
+            if len(pending) >= BULK_BATCH_SIZE:
+                yield flush()
+
+        if pending:
+            yield flush()
+        yield app.json.dumps({"summary": summary}) + "\n"
+
+    return app.response_class(stream_with_context(generate()), status=200, mimetype="application/x-ndjson")
+
+
+def create_client_document(cliente, timestamp, user, flight_data, electricity_data, gas_data, anno=None, document_type=None):
     """Crea il documento per il cliente."""
     return {
-        "nome": cliente["nome"],
+        "cliente_id": cliente["_id"],
         "timestamp": timestamp,
         "username": user["username"],
-        "utenti": cliente["utenti"],
+        "anno": anno,
+        "document_type": document_type,
         "dati": {
             "TotalFlightDist": flight_data,
             "Elettricità": electricity_data,
@@ -373,39 +1520,193 @@ def create_client_document(cliente, timestamp, user, flight_data, electricity_da
     }
 
 
-@app.route('/get_client_data', methods=['GET'])
-def get_client_data():
-    api_key = request.headers.get("X-API-KEY")
-    if not api_key:
-        return jsonify({"error": "API Key mancante"}), 401
+# Per ogni document_type: lista in `dati`, unità di misura e valore di un elemento valido
+ROLLUP_TYPES = {
+    "BUSINESS_TRAVEL": ("TotalFlightDist", "km", lambda item: item["impact"]),
+    "GAS": ("Gas", "sMc", lambda item: item["consumption_sMc"]["value"]),
+    "ELECTRICITY": ("Elettricità", "kWh", lambda item: item["total_electricity_consumption"]["value"]),
+}
+
+def rollup_update(nome, anno, document_type, value, documento):
+    """Restituisce filtro e update ($inc atomico) del rollup per un nuovo documento."""
+    field, unit, _ = ROLLUP_TYPES[document_type]
+    return (
+        {"nome": nome, "anno": anno, "document_type": document_type},
+        {
+            "$inc": {"value": value, "documents": 1, "items": len(documento["dati"][field])},
+            "$set": {"unit": unit, "updated_at": documento["timestamp"]}
+        }
+    )
 
-    user = users_collection.find_one({"api_key": api_key})
-    if not user:
-        return jsonify({"error": "API Key non valida"}), 401
+def infer_snapshot_year(document_type, items):
+    """Ricava l'anno di un documento storico salvato prima che venisse registrato `anno`.
+
+    Per i periodi a cavallo di due anni l'anno richiesto non è determinabile: si usa quello
+    più recente comune a tutti gli elementi (l'anno di fine periodo).
+    """
+    years = None
+    for item in items:
+        if document_type == "BUSINESS_TRAVEL":
+            item_years = {datetime.strptime(item["date"], "%Y-%m-%d").year}
+        else:
+            item_years = {
+                datetime.strptime(item["period"]["start_date"], "%Y-%m-%d").year,
+                datetime.strptime(item["period"]["end_date"], "%Y-%m-%d").year
+            }
+        # L'anno richiesto è comune a tutti gli elementi validi del documento
+        years = item_years if years is None else years & item_years
+    return max(years) if years else None
+
+def check_client_access(nome_cliente, api_key):
+    """Verifica che il cliente esista e che l'utente vi sia associato; restituisce il cliente."""
+    principal = resolve_principal(api_key)
+    if principal and principal["cliente"] and principal["cliente"]["nome"] == nome_cliente:
+        return principal["cliente"], None, None
+    cliente = client_collection.find_one({"nome": nome_cliente}, AUTH_CLIENT_PROJECTION)
+    if not cliente:
+        return None, {"error": "Cliente non trovato"}, 404
+    if memberships_collection.find_one({"cliente_id": cliente["_id"], "api_key": api_key}, {"_id": 1}):
+        return cliente, None, None
+    return None, {"error": "L'utente non è autorizzato a visualizzare i dati di questo cliente"}, 403
+
+
+@app.route('/get_client_trends', methods=['GET'])
+def get_client_trends():
+    api_key = request.headers.get("X-API-KEY")
+    user, error, status_code = validate_api_key(api_key)
+    if error:
+        return jsonify(error), status_code
 
     nome_cliente = request.args.get('nome')
     if not nome_cliente:
         return jsonify({"error": "Nome cliente mancante"}), 400
 
-    documenti_cliente = list(client_collection.find({"nome": nome_cliente}))
-    if not documenti_cliente:
-        return jsonify({"error": "Cliente non trovato"}), 404
+    query = {"nome": nome_cliente}
+    if request.args.get('anni'):
+        try:
+            query["anno"] = {"$in": [int(anno) for anno in request.args['anni'].split(',')]}
+        except ValueError:
+            return jsonify({"error": "Anno non valido. Deve essere un numero intero"}), 400
+
+    cliente, error, status_code = check_client_access(nome_cliente, api_key)
+    if error:
+        return jsonify(error), status_code
 
-    associato = any(api_key in documento.get("utenti", []) for documento in documenti_cliente)
-    if not associato:
-        return jsonify({"error": "L'utente non è autorizzato a visualizzare i dati di questo cliente"}), 403
+    # Un documento di rollup per anno e tipo: nessun ricalcolo sui dati grezzi
+    anni = {}
+    for rollup in rollups_collection.find(query, {"_id": 0, "nome": 0}).sort("anno", 1):
+        anni.setdefault(str(rollup["anno"]), {})[rollup["document_type"]] = {
+            "value": round(rollup["value"], 2),
+            "unit": rollup["unit"],
+            "documents": rollup["documents"],
+            "items": rollup["items"]
+        }
 
-    # Trova l'ultimo documento usando una data minima di default
-    ultimo_documento = max(
-        documenti_cliente,
-        key=lambda doc: doc.get("timestamp", datetime.min)
+    # Variazione rispetto all'anno precedente disponibile, per tipo
+    trend = {}
+    previous = {}
+    for anno, totali in anni.items():
+        for document_type, totale in totali.items():
+            if document_type in previous:
+                delta = round(totale["value"] - previous[document_type], 2)
+                trend.setdefault(document_type, []).append({
+                    "anno": int(anno),
+                    "delta": delta,
+                    "delta_pct": round(delta / previous[document_type] * 100, 2) if previous[document_type] else None
+                })
+            previous[document_type] = totale["value"]
+
+    return jsonify({"cliente": nome_cliente, "anni": anni, "trend": trend}), 200
+
+
+@app.cli.command("rebuild-rollups")
+def rebuild_rollups():
+    """Ricalcola da zero i rollup energetici a partire dai documenti storici dei clienti."""
+    init_mongo()
+    totals = {}
+    skipped = 0
+    # I rollup restano indicizzati per nome del cliente
+    nomi = {cliente["_id"]: cliente["nome"] for cliente in client_collection.find({}, {"nome": 1})}
+    cursor = snapshots_collection.find(
+        {},
+        {"cliente_id": 1, "timestamp": 1, "anno": 1, "document_type": 1, "dati": 1}
     )
+    for documento in cursor:
+        nome = nomi.get(documento["cliente_id"])
+        if nome is None:
+            skipped += 1
+            continue
+
+        dati = documento.get("dati") or {}
+        document_type = documento.get("document_type") or next(
+            (tipo for tipo, (field, _, _) in ROLLUP_TYPES.items() if dati.get(field)), None
+        )
+        if not document_type:
+            skipped += 1
+            continue
+
+        field, unit, item_value = ROLLUP_TYPES[document_type]
+        items = dati.get(field) or []
+        anno = documento.get("anno") or infer_snapshot_year(document_type, items)
+        if anno is None:
+            skipped += 1
+            continue
+
+        value = 0
+        for item in items:
+            value += item_value(item)
+
+        key = (nome, anno, document_type)
+        totale = totals.setdefault(key, {"value": 0, "documents": 0, "items": 0, "unit": unit, "updated_at": None})
+        totale["value"] += round(value, 2)
+        totale["documents"] += 1
+        totale["items"] += len(items)
+        if totale["updated_at"] is None or documento["timestamp"] > totale["updated_at"]:
+            totale["updated_at"] = documento["timestamp"]
+
+    ensure_indexes()
+    rollups_collection.delete_many({})
+    if totals:
+        rollups_collection.insert_many([
+            {"nome": nome, "anno": anno, "document_type": document_type, **totale}
+            for (nome, anno, document_type), totale in totals.items()
+        ])
+    print(f"Rollup ricalcolati: {len(totals)} (documenti ignorati: {skipped})")
+
+
+@app.route('/get_client_data', methods=['GET'])
+def get_client_data():
+    api_key = request.headers.get("X-API-KEY")
+    user, error, status_code = validate_api_key(api_key)
+    if error:
+        return jsonify(error), status_code
+
+    nome_cliente = request.args.get('nome')
+    if not nome_cliente:
+        return jsonify({"error": "Nome cliente mancante"}), 400
+
+    cliente, error, status_code = check_client_access(nome_cliente, api_key)
+    if error:
+        return jsonify(error), status_code
 
-    utenti_associati = users_collection.find({"api_key": {"$in": ultimo_documento.get("utenti", [])}})
+    # Ultimo documento tramite l'indice (cliente_id, timestamp), senza caricare lo storico
+    ultimo_documento = snapshots_collection.find_one(
+        {"cliente_id": cliente["_id"]},
+        {"timestamp": 1, "username": 1, "dati": 1},
+        sort=[("timestamp", -1)]
+    ) or cliente
+
+    api_keys = [membership["api_key"] for membership in memberships_collection.find(
+        {"cliente_id": cliente["_id"]}, {"_id": 0, "api_key": 1}
+    )]
+    utenti_associati = users_collection.find(
+        {"api_key": {"$in": api_keys}},
+        {"_id": 0, "username": 1, "email": 1}
+    )
     utenti = [{"username": utente["username"], "email": utente["email"]} for utente in utenti_associati]
 
     return jsonify({
-        "cliente": ultimo_documento["nome"],
+        "cliente": cliente["nome"],
         "timestamp": ultimo_documento.get("timestamp"),  # Usa get() per evitare errori
         "username": ultimo_documento.get("username"),  # Usa get() per evitare errori
         "dati": ultimo_documento.get("dati", {}),
@@ -413,139 +1714,777 @@ def get_client_data():
     }), 200
 
 
+HISTORY_PAGE_SIZE = 20
+HISTORY_MAX_PAGE_SIZE = 100
+
+def encode_history_cursor(documento):
+    """Cursore opaco per la pagina successiva: timestamp in millisecondi e _id dell'ultimo documento."""
+    millis = (documento["timestamp"] - datetime(1970, 1, 1)) // timedelta(milliseconds=1)
+    return f"{millis}_{documento['_id']}"
+
+def decode_history_cursor(cursor):
+    millis, _, object_id = cursor.partition("_")
+    return datetime(1970, 1, 1) + timedelta(milliseconds=int(millis)), ObjectId(object_id)
+
+@app.route('/get_client_history', methods=['GET'])
+def get_client_history():
+    api_key = request.headers.get("X-API-KEY")
+    user, error, status_code = validate_api_key(api_key)
+    if error:
+        return jsonify(error), status_code
+
+    nome_cliente = request.args.get('nome')
+    if not nome_cliente:
+        return jsonify({"error": "Nome cliente mancante"}), 400
+
+    try:
+        limit = max(1, min(int(request.args.get('limit', HISTORY_PAGE_SIZE)), HISTORY_MAX_PAGE_SIZE))
+    except ValueError:
+        return jsonify({"error": "Parametro limit non valido"}), 400
+
+    query = {}
+    if request.args.get('cursor'):
+        try:
+            timestamp, object_id = decode_history_cursor(request.args['cursor'])
+        except Exception:
+            return jsonify({"error": "Cursore non valido"}), 400
+        # Documenti successivi all'ultimo restituito nell'ordine (timestamp, _id) decrescente
+        query["$or"] = [
+            {"timestamp": {"$lt": timestamp}},
+            {"timestamp": timestamp, "_id": {"$lt": object_id}}
+        ]
+
+    cliente, error, status_code = check_client_access(nome_cliente, api_key)
+    if error:
+        return jsonify(error), status_code
+
+    query["cliente_id"] = cliente["_id"]
+    documenti = list(snapshots_collection.find(
+        query,
+        {"timestamp": 1, "username": 1, "anno": 1, "document_type": 1, "dati": 1}
+    ).sort([("timestamp", -1), ("_id", -1)]).limit(limit + 1))
+
+    # Un documento in più indica che esiste una pagina successiva
+    has_more = len(documenti) > limit
+    documenti = documenti[:limit]
+
+    return jsonify({
+        "cliente": nome_cliente,
+        "documenti": [
+            {
+                "timestamp": documento["timestamp"],
+                "username": documento.get("username"),
+                "anno": documento.get("anno"),
+                "document_type": documento.get("document_type"),
+                "dati": documento.get("dati", {})
+            }
+            for documento in documenti
+        ],
+        "next_cursor": encode_history_cursor(documenti[-1]) if has_more else None
+    }), 200
+
+
+EXPORT_BATCH_SIZE = int(os.getenv("EXPORT_BATCH_SIZE", "100"))  # Snapshot per batch del cursore MongoDB
+EXPORT_FLUSH_SIZE = 64 * 1024  # Byte accumulati prima di inviare un blocco al client
+EXPORT_COLUMNS = [
+    "timestamp", "username", "anno", "document_type", "sezione", "document_name", "date",
+    "start_date", "end_date", "from", "to", "num_of_travelers", "distance", "value", "unit"
+]
+
+def export_rows(cursor):
+    """Una riga piatta per ogni voce (voli, elettricità, gas) di ogni snapshot del cursore."""
+    for documento in cursor:
+        dati = documento.get("dati") or {}
+        for field, unit, item_value in ROLLUP_TYPES.values():
+            for item in dati.get(field) or []:
+                period = item.get("period") or {}
+                travel = item.get("travel") or {}
+                try:
+                    value = item_value(item)
+                except (KeyError, TypeError):
+                    value = None
+                yield {
+                    "timestamp": documento["timestamp"].isoformat(),
+                    "username": documento.get("username"),
+                    "anno": documento.get("anno"),
+                    "document_type": documento.get("document_type"),
+                    "sezione": field,
+                    "document_name": item.get("document_name"),
+                    "date": item.get("date"),
+                    "start_date": period.get("start_date"),
+                    "end_date": period.get("end_date"),
+                    "from": travel.get("from"),
+                    "to": travel.get("to"),
+                    "num_of_travelers": item.get("num_of_travelers"),
+                    "distance": item.get("distance"),
+                    "value": value,
+                    "unit": unit
+                }
+
+@app.route('/export_client_data', methods=['GET'])
+def export_client_data():
+    """Esporta in streaming (NDJSON o CSV) tutte le voci dello storico di un cliente.
+
+    Il cursore legge gli snapshot a blocchi di EXPORT_BATCH_SIZE e la risposta viene
+    prodotta a blocchi, compressa con gzip se il client lo accetta: la memoria usata
+    non dipende dalla lunghezza dello storico.
+    """
+    api_key = request.headers.get("X-API-KEY")
+    user, error, status_code = validate_api_key(api_key)
+    if error:
+        return jsonify(error), status_code
+
+    nome_cliente = request.args.get('nome')
+    if not nome_cliente:
+        return jsonify({"error": "Nome cliente mancante"}), 400
+
+    export_format = request.args.get('format', 'ndjson').lower()
+    if export_format not in ('ndjson', 'csv'):
+        return jsonify({"error": "Formato non supportato (ndjson o csv)"}), 400
+
+    cliente, error, status_code = check_client_access(nome_cliente, api_key)
+    if error:
+        return jsonify(error), status_code
+
+    cursor = snapshots_collection.find(
+        {"cliente_id": cliente["_id"]},
+        {"_id": 0, "timestamp": 1, "username": 1, "anno": 1, "document_type": 1, "dati": 1}
+    ).sort([("timestamp", 1), ("_id", 1)]).batch_size(EXPORT_BATCH_SIZE)
+    # La qualità conta: "gzip;q=0" significa che il client rifiuta gzip
+    use_gzip = request.accept_encodings["gzip"] > 0
+
+    def generate():
+        buffer = StringIO()
+        writer = csv.DictWriter(buffer, EXPORT_COLUMNS) if export_format == 'csv' else None
+        # wbits 31: formato gzip (intestazione e CRC) anziché zlib
+        compressor = zlib.compressobj(6, zlib.DEFLATED, 31) if use_gzip else None
+
+        def drain():
+            chunk = buffer.getvalue().encode("utf-8")
+            buffer.seek(0)
+            buffer.truncate()
+            return compressor.compress(chunk) if compressor else chunk
+
+        try:
+            if writer:
+                writer.writeheader()
+            for row in export_rows(cursor):
+                if writer:
+                    writer.writerow(row)
+                else:
+                    buffer.write(app.json.dumps(row) + "\n")
+                if buffer.tell() >= EXPORT_FLUSH_SIZE:
+                    chunk = drain()
+                    if chunk:
+                        yield chunk
+            chunk = drain()
+            if compressor:
+                chunk += compressor.flush()
+            if chunk:
+                yield chunk
+        finally:
+            cursor.close()
+
+    extension, mimetype = ("csv", "text/csv") if export_format == 'csv' else ("ndjson", "application/x-ndjson")
+    response = app.response_class(stream_with_context(generate()), status=200, mimetype=mimetype)
+    response.headers["Content-Disposition"] = f'attachment; filename="{secure_filename(nome_cliente) or "export"}.{extension}"'
+    response.vary.add("Accept-Encoding")
+    if use_gzip:
+        response.content_encoding = "gzip"
+    return response
+
+
+def get_file_category(content_type):
+    """Restituisce la categoria del file in base al content type (None se non supportato)."""
+    if content_type.startswith('image/'):
+        return "images"
+    elif content_type == 'application/pdf':
+        return "pdfs"
+    elif content_type in ['application/vnd.openxmlformats-officedocument.spreadsheetml.sheet', 'application/vnd.ms-excel']:
+        return "excels"
+    return None
+
+STORAGE_STATS_ID = "totals"
+
+def inc_storage_stats(**counters):
+    """Aggiorna con un $inc i contatori dello spazio occupato (files, logical_bytes, unique_blobs,
+    blob_bytes, legacy_bytes), così /stats/storage non deve scorrere files e file_blobs."""
+    storage_stats_collection.update_one({"_id": STORAGE_STATS_ID}, {"$inc": counters}, upsert=True)
+
+def store_blob(digest, size, content=None, gridfs_id=None):
+    """Registra un contenuto nel blob store indirizzato per SHA-256.
+
+    Se il contenuto esiste già incrementa solo il contatore dei riferimenti e restituisce
+    True (duplicato): in quel caso content/gridfs_id non vengono salvati.
+    """
+    if blobs_collection.find_one_and_update({"_id": digest}, {"$inc": {"refcount": 1}}, projection={"_id": 1}):
+        return True
+
+    blob = {"_id": digest, "size": size, "refcount": 1, "created_at": datetime.utcnow()}
+    if gridfs_id is not None:
+        blob["gridfs_id"] = gridfs_id
+    else:
+        blob["content"] = content
+    try:
+        blobs_collection.insert_one(blob)
+        inc_storage_stats(unique_blobs=1, blob_bytes=size)
+        return False
+    except DuplicateKeyError:
+        # Lo stesso contenuto è stato caricato in parallelo da un'altra richiesta
+        blobs_collection.update_one({"_id": digest}, {"$inc": {"refcount": 1}})
+        return True
+
+class UploadSink:
+    """Riceve un file a blocchi e ne sceglie lo storage senza tenerlo tutto in memoria.
+
+    Finché il contenuto non supera INLINE_BLOB_MAX_SIZE resta in un buffer (salvato poi in
+    file_blobs), oltre viene scritto in streaming su GridFS. Dimensione e SHA-256 sono
+    calcolati durante la scrittura; se il contenuto è già presente nel blob store non
+    viene salvata una nuova copia.
+    """
+
+    def __init__(self, filename, content_type, category):
+        self.filename = filename
+        self.content_type = content_type
+        self.category = category
+        self.size = 0
+        self.sha256 = hashlib.sha256()
+        self.buffer = bytearray()
+        self.grid_in = None
+
+    def write(self, data):
+        self.size += len(data)
+        self.sha256.update(data)
+        if self.grid_in is not None:
+            self.grid_in.write(data)
+            return
+
+        self.buffer += data
+        if len(self.buffer) > INLINE_BLOB_MAX_SIZE:
+            self.grid_in = fs.new_file(filename=self.filename, contentType=self.content_type)
+            self.grid_in.write(bytes(self.buffer))
+            self.buffer = bytearray()
+
+    def close(self):
+        """Chiude lo storage e restituisce il riferimento da salvare nei metadati."""
+        digest = self.sha256.hexdigest()
+        if self.grid_in is None:
+            store_blob(digest, self.size, content=bytes(self.buffer))
+            return {"blob_id": digest}
+
+        # Il contenuto grande è già in GridFS: se è un duplicato scarta la copia appena scritta
+        if blobs_collection.find_one({"_id": digest}, {"_id": 1}):
+            self.grid_in.abort()
+            store_blob(digest, self.size)
+            return {"blob_id": digest}
+
+        self.grid_in.close()
+        if store_blob(digest, self.size, gridfs_id=self.grid_in._id):
+            fs.delete(self.grid_in._id)
+        return {"blob_id": digest}
+
+    def abort(self):
+        if self.grid_in is not None:
+            self.grid_in.abort()
+
+def register_uploaded_file(user, sink):
+    """Salva i metadati del file ricevuto da sink e restituisce la voce per la risposta."""
+    file_id = ObjectId()
+    file_data = {
+        "owner_id": user["_id"],
+        "category": sink.category,
+        "file_id": file_id,
+        "filename": sink.filename,
+        "content_type": sink.content_type,
+        "size": sink.size,
+        "sha256": sink.sha256.hexdigest(),
+        "uploaded_at": datetime.utcnow(),
+        **sink.close()
+    }
+    files_collection.insert_one(file_data)
+    inc_storage_stats(files=1, logical_bytes=sink.size)
+    upload_bytes.inc(sink.size)
+    return {"filename": sink.filename, "file_id": str(file_id)}
+
 @app.route('/upload', methods=['POST'])
 def upload_files():
     api_key = request.headers.get("X-API-KEY")
-    if not api_key:
-        return jsonify({"error": "API Key mancante"}), 401
-
-    user = users_collection.find_one({"api_key": api_key})
-    if not user:
-        return jsonify({"error": "API Key non valida"}), 401
+    user, error, status_code = validate_api_key(api_key)
+    if error:
+        return jsonify(error), status_code
 
-    if 'file' not in request.files:
+    # Legge il corpo multipart a blocchi e scrive ogni file direttamente nello storage
+    mimetype, options = parse_options_header(request.headers.get("Content-Type", ""))
+    if mimetype != "multipart/form-data" or not options.get("boundary"):
         return jsonify({"error": "Nessun file trovato nella richiesta"}), 400
 
-    files = request.files.getlist('file')
+    decoder = MultipartDecoder(options["boundary"].encode("latin-1"), max_form_memory_size=2 * UPLOAD_CHUNK_SIZE)
     uploaded_files = []
+    found = False
+    sink = None  # File in scrittura (None se la parte corrente va ignorata)
 
-    for file in files:
-        filename = file.filename
-        content_type = file.content_type
-        file_content = file.read()
-        file_size = len(file_content)
-
-        file_id = ObjectId()
-        file_data = {
-            "file_id": file_id,
-            "filename": filename,
-            "content_type": content_type,
-            "uploaded_at": datetime.utcnow()
-        }
-
-        if file_size <= 16 * 1024 * 1024:  # File piccoli
-            file_data["content"] = file_content
-        else:  # File grandi
-            gridfs_id = fs.put(file_content, filename=filename, contentType=content_type)
-            file_data["gridfs_id"] = gridfs_id
-
-        # Determina la categoria dei file
-        if content_type.startswith('image/'):
-            category = "files.images"
-        elif content_type == 'application/pdf':
-            category = "files.pdfs"
-        elif content_type in ['application/vnd.openxmlformats-officedocument.spreadsheetml.sheet', 'application/vnd.ms-excel']:
-            category = "files.excels"
-        else:
-            return jsonify({"error": f"Tipo di file non supportato: {filename}"}), 400
+    try:
+        while True:
+            chunk = request.stream.read(UPLOAD_CHUNK_SIZE)
+            decoder.receive_data(chunk or None)
+            event = decoder.next_event()
+            while not isinstance(event, (Epilogue, NeedData)):
+                if isinstance(event, File) and event.name == 'file':
+                    found = True
+                    filename = event.filename
+                    content_type = event.headers.get("Content-Type", "")
+
+                    # Determina la categoria dei file
+                    category = get_file_category(content_type)
+                    if not category:
+                        return jsonify({"error": f"Tipo di file non supportato: {filename}"}), 400
+                    sink = UploadSink(filename, content_type, category)
+                elif isinstance(event, (Field, File)):
+                    sink = None
+                elif isinstance(event, Data) and sink:
+                    sink.write(event.data)
+                    if not event.more_data:
+                        uploaded_files.append(register_uploaded_file(user, sink))
+                        sink = None
+                event = decoder.next_event()
+            if not chunk or isinstance(event, Epilogue):
+                break
+    except ValueError:
+        # Corpo multipart troncato o malformato (il decoder non può proseguire)
+        if sink:
+            sink.abort()
+        return jsonify({"error": "Nessun file trovato nella richiesta"}), 400
+    except Exception:
+        if sink:
+            sink.abort()
+        raise
 
-        # Aggiungi il file nella categoria corretta
-        users_collection.update_one(
-            {"api_key": api_key},
-            {"$push": {category: file_data}}
-        )
-        uploaded_files.append({"filename": filename, "file_id": str(file_id)})
+    if not found:
+        return jsonify({"error": "Nessun file trovato nella richiesta"}), 400
 
     return jsonify({"user": user["username"], "uploaded_files": uploaded_files}), 200
 
 
+UPLOAD_SESSION_TTL = int(os.getenv("UPLOAD_SESSION_TTL", str(24 * 3600)))
+UPLOAD_SESSION_CHUNK_MAX = int(os.getenv("UPLOAD_SESSION_CHUNK_MAX", str(8 * 1024 * 1024)))  # Sotto il limite di 16 MB dei documenti
+UPLOAD_SESSION_MAX_CHUNKS = int(os.getenv("UPLOAD_SESSION_MAX_CHUNKS", "10000"))
+# Completamento senza aggiornamenti da più tempo: il processo è morto e la sessione si può ricompletare
+UPLOAD_SESSION_COMPLETING_STALE = int(os.getenv("UPLOAD_SESSION_COMPLETING_STALE", "300"))
+
+def get_upload_session(user, upload_id):
+    """Trova la sessione di upload dell'utente (non scaduta)."""
+    session = None
+    if ObjectId.is_valid(upload_id):
+        session = upload_sessions_collection.find_one({
+            "_id": ObjectId(upload_id),
+            "owner_id": user["_id"],
+            # L'indice TTL elimina le sessioni con ritardo: filtra comunque quelle scadute
+            "expires_at": {"$gt": datetime.utcnow()}
+        })
+    if not session:
+        return None, {"error": "Sessione di upload non trovata"}, 404
+    return session, None, None
+
+def format_upload_session(session):
+    return {
+        "upload_id": str(session["_id"]),
+        "filename": session["filename"],
+        "content_type": session["content_type"],
+        "size": session.get("size"),
+        "status": session["status"],
+        "chunk_size_max": UPLOAD_SESSION_CHUNK_MAX,
+        "expires_at": session["expires_at"]
+    }
+
+@app.route('/upload_sessions', methods=['POST'])
+def create_upload_session():
+    """Apre un upload riprendibile: i blocchi si inviano poi con PUT, anche in parallelo."""
+    api_key = request.headers.get("X-API-KEY")
+    user, error, status_code = validate_api_key(api_key)
+    if error:
+        return jsonify(error), status_code
+
+    data = request.get_json(silent=True)
+    if not isinstance(data, dict) or not data.get('filename') or not data.get('content_type'):
+        return jsonify({"error": "filename e content_type mancanti"}), 400
+    if not isinstance(data['filename'], str) or not isinstance(data['content_type'], str):
+        return jsonify({"error": "filename e content_type devono essere stringhe"}), 400
+
+    category = get_file_category(data['content_type'])
+    if not category:
+        return jsonify({"error": f"Tipo di file non supportato: {data['filename']}"}), 400
+
+    size = data.get('size')
+    # bool è una sottoclasse di int: "size": true non è una dimensione
+    if size is not None and (not isinstance(size, int) or isinstance(size, bool) or size < 0):
+        return jsonify({"error": "Dimensione non valida"}), 400
+
+    now = datetime.utcnow()
+    session = {
+        "owner_id": user["_id"],
+        "filename": data['filename'],
+        "content_type": data['content_type'],
+        "category": category,
+        "size": size,  # Dimensione dichiarata, verificata al completamento
+        "status": "open",
+        "created_at": now,
+        "expires_at": now + timedelta(seconds=UPLOAD_SESSION_TTL)
+    }
+    upload_sessions_collection.insert_one(session)
+    return jsonify(format_upload_session(session)), 201
+
+@app.route('/upload_sessions/<upload_id>', methods=['GET'])
+def get_upload_session_status(upload_id):
+    """Stato della sessione e blocchi già ricevuti, per riprendere un upload interrotto."""
+    api_key = request.headers.get("X-API-KEY")
+    user, error, status_code = validate_api_key(api_key)
+    if error:
+        return jsonify(error), status_code
+
+    session, error, status_code = get_upload_session(user, upload_id)
+    if error:
+        return jsonify(error), status_code
+
+    chunks = upload_chunks_collection.find(
+        {"session_id": session["_id"]}, {"_id": 0, "index": 1, "size": 1, "sha256": 1}
+    ).sort("index", 1)
+    return jsonify({**format_upload_session(session), "file_id": session.get("file_id"), "chunks": list(chunks)}), 200
+
+@app.route('/upload_sessions/<upload_id>/chunks/<int:index>', methods=['PUT'])
+def put_upload_chunk(upload_id, index):
+    """Salva il blocco numero `index` (da 0). Ripetere lo stesso PUT sostituisce il blocco."""
+    api_key = request.headers.get("X-API-KEY")
+    user, error, status_code = validate_api_key(api_key)
+    if error:
+        return jsonify(error), status_code
+
+    if index >= UPLOAD_SESSION_MAX_CHUNKS:
+        return jsonify({"error": "Numero di blocco non valido"}), 400
+    if request.content_length is not None and request.content_length > UPLOAD_SESSION_CHUNK_MAX:
+        return jsonify({"error": f"Blocco troppo grande (massimo {UPLOAD_SESSION_CHUNK_MAX} byte)"}), 413
+
+    session, error, status_code = get_upload_session(user, upload_id)
+    if error:
+        return jsonify(error), status_code
+    if session["status"] != "open":
+        return jsonify({"error": "La sessione di upload è già stata completata"}), 409
+
+    # Legge il corpo a blocchi fino al limite (anche senza Content-Length)
+    content = bytearray()
+    while True:
+        data = request.stream.read(UPLOAD_CHUNK_SIZE)
+        if not data:
+            break
+        content += data
+        if len(content) > UPLOAD_SESSION_CHUNK_MAX:
+            return jsonify({"error": f"Blocco troppo grande (massimo {UPLOAD_SESSION_CHUNK_MAX} byte)"}), 413
+    if not content:
+        return jsonify({"error": "Blocco vuoto"}), 400
+
+    digest = hashlib.sha256(content).hexdigest()
+    expected = request.headers.get("X-Chunk-SHA256")
+    if expected and expected.lower() != digest:
+        return jsonify({"error": "SHA-256 del blocco non corrispondente"}), 400
+
+    upload_chunks_collection.replace_one(
+        {"session_id": session["_id"], "index": index},
+        {
+            "session_id": session["_id"],
+            "index": index,
+            "data": Binary(bytes(content)),
+            "size": len(content),
+            "sha256": digest,
+            "expires_at": session["expires_at"]
+        },
+        upsert=True
+    )
+    # Il corpo può aver impiegato a lungo ad arrivare: se intanto è partito il completamento il blocco
+    # non fa parte del file (il completamento se ne accorge dallo SHA-256) e non deve restare orfano
+    if not upload_sessions_collection.find_one({"_id": session["_id"], "status": "open"}, {"_id": 1}):
+        upload_chunks_collection.delete_one({"session_id": session["_id"], "index": index, "sha256": digest})
+        return jsonify({"error": "La sessione di upload è già in completamento o completata"}), 409
+    return jsonify({"index": index, "size": len(content), "sha256": digest}), 200
+
+@app.route('/upload_sessions/<upload_id>/complete', methods=['POST'])
+def complete_upload_session(upload_id):
+    """Unisce i blocchi in ordine nello storage dei file (GridFS oltre INLINE_BLOB_MAX_SIZE) e registra il file."""
+    api_key = request.headers.get("X-API-KEY")
+    user, error, status_code = validate_api_key(api_key)
+    if error:
+        return jsonify(error), status_code
+
+    session, error, status_code = get_upload_session(user, upload_id)
+    if error:
+        return jsonify(error), status_code
+
+    # Completamento idempotente: una seconda chiamata restituisce lo stesso file
+    if session["status"] == "completed":
+        uploaded = {"filename": session["filename"], "file_id": str(session["file_id"])}
+        return jsonify({"user": user["username"], "uploaded_files": [uploaded]}), 200
+
+    # Un solo completamento alla volta per sessione; uno rimasto fermo (processo terminato) si può riprendere
+    now = datetime.utcnow()
+    completion_id = ObjectId()
+    if not upload_sessions_collection.find_one_and_update(
+        {"_id": session["_id"], "$or": [
+            {"status": "open"},
+            {"status": "completing", "completing_at": {"$lt": now - timedelta(seconds=UPLOAD_SESSION_COMPLETING_STALE)}}
+        ]},
+        {"$set": {"status": "completing", "completing_at": now, "completion_id": completion_id}}
+    ):
+        return jsonify({"error": "Completamento già in corso"}), 409
+
+    owned = {"_id": session["_id"], "status": "completing", "completion_id": completion_id}
+
+    def release():
+        upload_sessions_collection.update_one(owned, {"$set": {"status": "open"}, "$unset": {"completing_at": "", "completion_id": ""}})
+
+    # Elenco dei blocchi letto dopo aver chiuso la sessione: un PUT arrivato nel frattempo
+    # viene annullato da put_upload_chunk o rilevato qui sotto confrontando gli SHA-256
+    chunks = list(upload_chunks_collection.find({"session_id": session["_id"]}, {"_id": 0, "index": 1, "size": 1, "sha256": 1}).sort("index", 1))
+    if not chunks or [chunk["index"] for chunk in chunks] != list(range(len(chunks))):
+        release()
+        return jsonify({"error": "Blocchi mancanti", "chunks": [chunk["index"] for chunk in chunks]}), 400
+    size = sum(chunk["size"] for chunk in chunks)
+    if session.get("size") is not None and size != session["size"]:
+        release()
+        return jsonify({"error": f"Dimensione ricevuta ({size}) diversa da quella dichiarata ({session['size']})"}), 400
+
+    sink = UploadSink(session["filename"], session["content_type"], session["category"])
+    try:
+        # Un blocco alla volta: la memoria usata non dipende dalla dimensione del file
+        cursor = upload_chunks_collection.find(
+            {"session_id": session["_id"]}, {"_id": 0, "index": 1, "sha256": 1, "data": 1}
+        ).sort("index", 1).batch_size(1)
+        heartbeat = time.monotonic()
+        streamed = 0
+        for chunk in cursor:
+            if streamed >= len(chunks) or (chunk["index"], chunk["sha256"]) != (chunks[streamed]["index"], chunks[streamed]["sha256"]):
+                break
+            sink.write(chunk["data"])
+            streamed += 1
+            # Heartbeat: un completamento lungo ma vivo non deve essere considerato fermo
+            if time.monotonic() - heartbeat >= UPLOAD_SESSION_COMPLETING_STALE / 3:
+                heartbeat = time.monotonic()
+                if not upload_sessions_collection.update_one(owned, {"$set": {"completing_at": datetime.utcnow()}}).matched_count:
+                    sink.abort()
+                    return jsonify({"error": "Completamento ripreso da un'altra richiesta"}), 409
+        if streamed != len(chunks):
+            sink.abort()
+            release()
+            return jsonify({"error": "Blocchi modificati durante il completamento, riprovare"}), 409
+        uploaded = register_uploaded_file(user, sink)
+    except Exception:
+        sink.abort()
+        release()
+        raise
+
+    upload_sessions_collection.update_one(
+        {"_id": session["_id"]},
+        {"$set": {"status": "completed", "file_id": ObjectId(uploaded["file_id"])},
+         "$unset": {"completing_at": "", "completion_id": ""}}
+    )
+    upload_chunks_collection.delete_many({"session_id": session["_id"]})
+    return jsonify({"user": user["username"], "uploaded_files": [uploaded]}), 200
+
+@app.route('/upload_sessions/<upload_id>', methods=['DELETE'])
+def delete_upload_session(upload_id):
+    """Annulla un upload e libera subito i blocchi ricevuti."""
+    api_key = request.headers.get("X-API-KEY")
+    user, error, status_code = validate_api_key(api_key)
+    if error:
+        return jsonify(error), status_code
+
+    session, error, status_code = get_upload_session(user, upload_id)
+    if error:
+        return jsonify(error), status_code
+    if session["status"] == "completing":
+        return jsonify({"error": "Completamento in corso"}), 409
+
+    upload_chunks_collection.delete_many({"session_id": session["_id"]})
+    upload_sessions_collection.delete_one({"_id": session["_id"]})
+    return jsonify({"message": "Sessione di upload annullata"}), 200
+
+
 
 @app.route('/get_user_files', methods=['GET'])
 def get_user_files():
     # Recupera la chiave API dagli header
     api_key = request.headers.get("X-API-KEY")
-    if not api_key:
-        return jsonify({"error": "API Key mancante"}), 401
 
     # Verifica se l'API Key è valida
-    user = users_collection.find_one({"api_key": api_key})
-    if not user:
-        return jsonify({"error": "API Key non valida"}), 401
+    user, error, status_code = validate_api_key(api_key)
+    if error:
+        return jsonify(error), status_code
 
-    # Funzione per formattare i file e convertire ObjectId in stringa
-    def format_files(files):
-        formatted_files = []
-        for file in files:
-            formatted_file = {key: str(value) if isinstance(value, ObjectId) else value
-                              for key, value in file.items() if key != "content"}
-            formatted_files.append(formatted_file)
-        return formatted_files
+    files = {category: [] for category in FILE_CATEGORIES}
+    cursor = files_collection.find(
+        {"owner_id": user["_id"]},
+        {"_id": 0, "owner_id": 0, "blob_id": 0, "size": 0, "sha256": 0}
+    ).sort("uploaded_at", 1)
+    for file in cursor:
+        # ObjectId e date vengono serializzati direttamente dal provider JSON
+        files.setdefault(file.pop("category"), []).append(file)
 
     # Restituisce solo i metadati dei file
     return jsonify({
         "username": user["username"],
-        "files": {
-            "pdfs": format_files(user["files"]["pdfs"]),
-            "images": format_files(user["files"]["images"]),
-            "excels": format_files(user["files"]["excels"]),
-        },
+        "files": files,
     }), 200
 
 @app.route('/download', methods=['GET'])
 def download_file():
     api_key = request.headers.get("X-API-KEY")
-    if not api_key:
-        return jsonify({"error": "API Key mancante"}), 401
-
-    user = users_collection.find_one({"api_key": api_key})
-    if not user:
-        return jsonify({"error": "API Key non valida"}), 401
+    user, error, status_code = validate_api_key(api_key)
+    if error:
+        return jsonify(error), status_code
 
     file_id = request.args.get('file_id')
     if not file_id:
         return jsonify({"error": "file_id mancante"}), 400
 
-    # Cerca il file in tutte le categorie
+    # Cerca il file tramite l'indice (owner_id, file_id)
     file = None
-    for category in ["pdfs", "images", "excels"]:
-        file = next((f for f in user["files"][category] if str(f["file_id"]) == file_id), None)
-        if file:
-            break
+    if ObjectId.is_valid(file_id):
+        file = files_collection.find_one({"owner_id": user["_id"], "file_id": ObjectId(file_id)})
 
     if not file:
         return jsonify({"error": "File non trovato"}), 404
 
+    # Il contenuto di un file non cambia mai: se il client ha già questa versione risponde 304
+    etag = file.get("sha256") or str(file["file_id"])
+    if request.if_none_match.contains(etag):
+        response = app.response_class(status=304)
+        response.set_etag(etag)
+        return response
+
     try:
         if "gridfs_id" in file:
+            # GridOut è leggibile a blocchi e supporta seek: i chunk vengono letti solo durante l'invio
             gridfs_file = fs.get(file["gridfs_id"])
-            return send_file(
-                BytesIO(gridfs_file.read()),
-                as_attachment=True,
-                download_name=file["filename"],
-                mimetype=file["content_type"]
-            )
-        elif "content" in file:
-            return send_file(
-                BytesIO(file["content"]),
-                as_attachment=True,
-                download_name=file["filename"],
-                mimetype=file["content_type"]
-            )
+            return send_stored_file(file, gridfs_file, gridfs_file.length, etag)
+        elif "blob_id" in file:
+            blob = blobs_collection.find_one({"_id": file["blob_id"]})
+            if not blob:
+                return jsonify({"error": "Il file non contiene dati validi"}), 500
+            if "gridfs_id" in blob:
+                gridfs_file = fs.get(blob["gridfs_id"])
+                return send_stored_file(file, gridfs_file, gridfs_file.length, etag)
+            return send_stored_file(file, BytesIO(blob["content"]), len(blob["content"]), etag)
         else:
             return jsonify({"error": "Il file non contiene dati validi"}), 500
+    except HTTPException:
+        raise
     except Exception as e:
         return jsonify({"error": f"Errore durante il download del file: {str(e)}"}), 500
 
+def send_stored_file(file, stream, length, etag):
+    """Invia il file in streaming con supporto per Range (206), ETag e Last-Modified."""
+    response = send_file(
+        stream,
+        as_attachment=True,
+        download_name=file["filename"],
+        mimetype=file["content_type"],
+        conditional=False,
+        etag=etag,
+        last_modified=file.get("uploaded_at")
+    )
+    response.content_length = length
+    return response.make_conditional(request, accept_ranges=True, complete_length=length)
+
+@app.cli.command("migrate-user-files")
+def migrate_user_files():
+    """Sposta i file incorporati nei documenti utente nelle collezioni files/file_blobs."""
+    init_mongo()
+    ensure_indexes()
+    migrated = 0
+    for user in users_collection.find({"files": {"$exists": True}}, {"files": 1}):
+        for category, files in (user.get("files") or {}).items():
+            for file in files:
+                file_data = {
+                    "owner_id": user["_id"],
+                    "category": category,
+                    "file_id": file["file_id"],
+                    "filename": file.get("filename"),
+                    "content_type": file.get("content_type"),
+                    "uploaded_at": file.get("uploaded_at")
+                }
+                if "gridfs_id" in file:
+                    file_data["gridfs_id"] = file["gridfs_id"]
+                    file_data["size"] = fs.get(file["gridfs_id"]).length
+                elif "content" in file:
+                    file_data["blob_id"] = hashlib.sha256(file["content"]).hexdigest()
+                    file_data["sha256"] = file_data["blob_id"]
+                    file_data["size"] = len(file["content"])
+
+                result = files_collection.update_one(
+                    {"owner_id": user["_id"], "file_id": file["file_id"]},
+                    {"$setOnInsert": file_data},
+                    upsert=True
+                )
+                # Il riferimento al blob viene contato solo alla prima migrazione del file
+                if result.upserted_id is not None:
+                    size = file_data.get("size", 0)
+                    if "blob_id" in file_data:
+                        store_blob(file_data["blob_id"], size, content=file["content"])
+                        inc_storage_stats(files=1, logical_bytes=size)
+                    else:
+                        # Il file resta in GridFS con una copia propria
+                        inc_storage_stats(files=1, logical_bytes=size, legacy_bytes=size)
+                migrated += 1
+
+        users_collection.update_one({"_id": user["_id"]}, {"$unset": {"files": ""}})
+    print(f"Migrazione completata: {migrated} file spostati")
+
+@app.cli.command("migrate-client-data")
+def migrate_client_data():
+    """Sposta associazioni utente-cliente e documenti energetici fuori dalla collezione clients.
+
+    Idempotente: può essere rieseguita dopo un'interruzione.
+    """
+    init_mongo()
+    ensure_indexes()
+    memberships = 0
+    snapshots = 0
+    for nome in client_collection.distinct("nome"):
+        documenti = list(client_collection.find({"nome": nome}, {"dati": 0}).sort([("timestamp", 1), ("_id", 1)]))
+        # Il documento del cliente è quello creato da /create_client (senza username)
+        cliente = next((documento for documento in documenti if "username" not in documento), None)
+        if cliente is None:
+            cliente = {"nome": nome, "timestamp": documenti[0].get("timestamp")}
+            cliente["_id"] = client_collection.insert_one(cliente).inserted_id
+
+        # Le associazioni sono l'unione delle liste utenti copiate nei documenti
+        api_keys = {api_key for documento in documenti for api_key in documento.get("utenti", [])}
+        if api_keys:
+            memberships_collection.bulk_write([
+                UpdateOne(
+                    {"cliente_id": cliente["_id"], "api_key": api_key},
+                    {"$setOnInsert": {"created_at": datetime.utcnow()}},
+                    upsert=True
+                )
+                for api_key in api_keys
+            ], ordered=False)
+            memberships += len(api_keys)
+
+        # Gli snapshot mantengono lo stesso _id (cursori dello storico ancora validi)
+        snapshot_ids = [documento["_id"] for documento in documenti if "username" in documento]
+        for start in range(0, len(snapshot_ids), BULK_BATCH_SIZE):
+            batch = snapshot_ids[start:start + BULK_BATCH_SIZE]
+            operations = []
+            for documento in client_collection.find({"_id": {"$in": batch}}):
+                documento.pop("nome", None)
+                documento.pop("utenti", None)
+                documento["cliente_id"] = cliente["_id"]
+                operations.append(ReplaceOne({"_id": documento["_id"]}, documento, upsert=True))
+            if operations:
+                snapshots_collection.bulk_write(operations, ordered=False)
+            client_collection.delete_many({"_id": {"$in": batch}})
+            snapshots += len(batch)
+
+        client_collection.update_one({"_id": cliente["_id"]}, {"$unset": {"utenti": "", "dati": ""}})
+    print(f"Migrazione completata: {memberships} associazioni, {snapshots} documenti spostati")
+
 @app.route('/routes', methods=['GET'])
 def list_routes():
     import urllib
@@ -556,9 +2495,291 @@ def list_routes():
         output.append(line)
     return jsonify(routes=output)
 
+@app.route('/stats/distance_cache', methods=['GET'])
+def distance_cache_stats():
+    return jsonify(get_distance_cache_stats()), 200
+
+@app.route('/stats/storage', methods=['GET'])
+def storage_stats():
+    # Byte logici (somma dei file caricati) contro byte fisici (contenuti distinti salvati)
+    totals = storage_stats_collection.find_one({"_id": STORAGE_STATS_ID}) or {}
+    logical_bytes = totals.get("logical_bytes", 0)
+    stored_bytes = totals.get("blob_bytes", 0) + totals.get("legacy_bytes", 0)
+    return jsonify({
+        "files": totals.get("files", 0),
+        "unique_blobs": totals.get("unique_blobs", 0),
+        "logical_bytes": logical_bytes,
+        "stored_bytes": stored_bytes,
+        "dedup_ratio": round(logical_bytes / stored_bytes, 2) if stored_bytes else None
+    }), 200
+
+@app.cli.command("rebuild-storage-stats")
+def rebuild_storage_stats():
+    """Ricalcola da zero i contatori di /stats/storage scorrendo files e file_blobs."""
+    init_mongo()
+    logical = next(files_collection.aggregate([{"$group": {
+        "_id": None,
+        "files": {"$sum": 1},
+        "bytes": {"$sum": {"$ifNull": ["$size", 0]}},
+        # I file caricati prima del blob store (blob_id diverso dallo SHA-256) hanno una copia propria
+        "legacy_bytes": {"$sum": {"$cond": [
+            {"$eq": [{"$ifNull": ["$blob_id", None]}, {"$ifNull": ["$sha256", ""]}]}, 0, {"$ifNull": ["$size", 0]}
+        ]}}
+    }}]), {"files": 0, "bytes": 0, "legacy_bytes": 0})
+    physical = next(blobs_collection.aggregate([
+        {"$match": {"size": {"$exists": True}}},
+        {"$group": {"_id": None, "blobs": {"$sum": 1}, "bytes": {"$sum": "$size"}}}
+    ]), {"blobs": 0, "bytes": 0})
+
+    totals = {
+        "files": logical["files"],
+        "logical_bytes": logical["bytes"],
+        "legacy_bytes": logical["legacy_bytes"],
+        "unique_blobs": physical["blobs"],
+        "blob_bytes": physical["bytes"]
+    }
+    storage_stats_collection.replace_one({"_id": STORAGE_STATS_ID}, totals, upsert=True)
+    print(f"Contatori ricalcolati: {totals}")
+
+PROFILER_ENABLED = os.getenv("PROFILER_ENABLED", "").lower() in ("1", "true")
+PROFILER_INTERVAL = float(os.getenv("PROFILER_INTERVAL_MS", "5")) / 1000
+PROFILER_SLOW_SECONDS = float(os.getenv("PROFILER_SLOW_MS", "500")) / 1000
+
+class StackSampler:
+    """Profiler a campionamento: registra periodicamente lo stack del thread di una richiesta."""
+
+    def __init__(self, thread_id, interval):
+        self.thread_id = thread_id
+        self.interval = interval
+        self.samples = Counter()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            stack = []
+            while frame is not None:
+                stack.append(f"{frame.f_code.co_name} ({os.path.basename(frame.f_code.co_filename)}:{frame.f_lineno})")
+                frame = frame.f_back
+            self.samples[";".join(reversed(stack))] += 1
+
+@app.before_request
+def start_request_timer():
+    g.request_start = time.perf_counter()
+    # Con PROFILER_ENABLED una richiesta con "X-Profile: 1" viene campionata
+    if PROFILER_ENABLED and request.headers.get("X-Profile") == "1":
+        g.sampler = StackSampler(threading.get_ident(), PROFILER_INTERVAL).start()
+
+@app.after_request
+def record_request_metrics(response):
+    elapsed = time.perf_counter() - g.get("request_start", time.perf_counter())
+    route = request.url_rule.rule if request.url_rule else "unmatched"
+    http_request_duration.observe(elapsed, route, request.method, str(response.status_code))
+    if request.endpoint == "download_file" and response.status_code in (200, 206) and response.content_length:
+        download_bytes.inc(response.content_length)
+
+    sampler = g.pop("sampler", None)
+    if sampler:
+        sampler.stop()
+        if elapsed >= PROFILER_SLOW_SECONDS:
+            print(f"Profilo di {request.method} {request.path} ({elapsed * 1000:.0f} ms, {sum(sampler.samples.values())} campioni):")
+            for stack, count in sampler.samples.most_common(10):
+                print(f"  {count:5d} {stack}")
+    return response
+
+# --- Controllo di ammissione: token bucket per API Key e limite globale di richieste in corso ---
+
+RATE_LIMIT_ENABLED = os.getenv("RATE_LIMIT_ENABLED", "1") == "1"
+RATE_LIMIT_RATE = float(os.getenv("RATE_LIMIT_RATE", "10"))  # Token ricaricati al secondo per API Key
+RATE_LIMIT_BURST = float(os.getenv("RATE_LIMIT_BURST", "60"))  # Capacità del bucket
+RATE_LIMIT_BACKEND = os.getenv("RATE_LIMIT_BACKEND", "memory")  # "memory" (per processo) oppure "mongo" (condiviso)
+RATE_LIMIT_KEYS = int(os.getenv("RATE_LIMIT_KEYS", "100000"))
+# Richieste in corso per processo (0 = nessun limite). Con gunicorn gthread non possono superare i thread
+# del worker: le altre attendono nella coda di gunicorn, quindi di default il limite coincide con i thread
+# e protegge solo altri server (es. flask run). Sotto gunicorn il sovraccarico si rileva dall'attesa in coda:
+# impostare MAX_QUEUE_WAIT_MS con un proxy che invia X-Request-Start, altrimenti nessuna richiesta viene
+# rifiutata con 503 (resta attivo solo il rate limit per API Key).
+MAX_IN_FLIGHT = int(os.getenv("MAX_IN_FLIGHT", os.getenv("GUNICORN_THREADS", "8")))
+# Attesa massima in coda (ms) misurata dall'header X-Request-Start del proxy (0 = controllo disattivato)
+MAX_QUEUE_WAIT_MS = int(os.getenv("MAX_QUEUE_WAIT_MS", "0"))
+
+# Token consumati per richiesta in base all'endpoint (1 per quelli non elencati)
+RATE_LIMIT_WEIGHTS = {
+    "add_energy_data": 5,
+    "add_energy_data_bulk": 20,
+    "upload_files": 10,
+    "put_upload_chunk": 2,
+    "complete_upload_session": 5,
+    "download_file": 2,
+    "export_client_data": 10,
+}
+# Endpoint mai rifiutati (monitoraggio)
+ADMISSION_EXEMPT_ENDPOINTS = {"home", "metrics", "list_routes", "distance_cache_stats"}
+# Bucket condiviso da tutte le API Key non valide: chiavi inventate non creano bucket nuovi
+INVALID_API_KEY_BUCKET = "__invalid__"
+
+def request_queue_wait_ms():
+    """Millisecondi trascorsi da quando il proxy ha ricevuto la richiesta (header X-Request-Start),
+    oppure None se l'header manca o non è leggibile. Accetta "t=<ms>", millisecondi o secondi."""
+    header = request.headers.get("X-Request-Start", "")
+    try:
+        started = float(header.strip().removeprefix("t="))
+    except ValueError:
+        return None
+    if started < 1e11:
+        started *= 1000  # Secondi epoch
+    elif started > 1e14:
+        started /= 1000  # Microsecondi epoch
+    return max(0.0, time.time() * 1000 - started)
+
+class TokenBucketLimiter:
+    """Token bucket per chiave, in memoria. acquire() restituisce 0 se la richiesta è ammessa,
+    altrimenti i secondi da attendere prima di riprovare."""
+
+    def __init__(self, rate, burst, maxsize):
+        self.rate = rate
+        self.burst = burst
+        # Secondi per ricaricare un bucket vuoto: dopo, un bucket scaduto è comunque di nuovo pieno
+        self.idle_seconds = max(1, math.ceil(burst / rate))
+        self.buckets = LRUCache(maxsize, self.idle_seconds)
+        self._lock = threading.Lock()
+
+    def acquire(self, key, cost):
+        cost = min(cost, self.burst)
+        now = time.monotonic()
+        with self._lock:
+            tokens, updated_at = self.buckets.get(key) or (self.burst, now)
+            tokens = min(self.burst, tokens + (now - updated_at) * self.rate)
+            if tokens >= cost:
+                self.buckets.set(key, (tokens - cost, now))
+                return 0
+            self.buckets.set(key, (tokens, now))
+        return (cost - tokens) / self.rate
+
+class MongoTokenBucketLimiter(TokenBucketLimiter):
+    """Token bucket condiviso tra processi: ricarica e consumo in un solo update atomico (pipeline)."""
+
+    def acquire(self, key, cost):
+        cost = min(cost, self.burst)
+        now = datetime.utcnow()
+        elapsed_ms = {"$max": [0, {"$subtract": [now, {"$ifNull": ["$updated_at", now]}]}]}
+        try:
+            bucket = rate_limits_collection.find_one_and_update(
+                {"_id": key},
+                [
+                    {"$set": {
+                        "tokens": {"$min": [self.burst, {"$add": [
+                            {"$ifNull": ["$tokens", self.burst]},
+                            {"$multiply": [{"$divide": [elapsed_ms, 1000]}, self.rate]}
+                        ]}]},
+                        "updated_at": now,
+                        "expires_at": now + timedelta(seconds=self.idle_seconds)
+                    }},
+                    {"$set": {"allowed": {"$gte": ["$tokens", cost]}}},
+                    {"$set": {"tokens": {"$cond": ["$allowed", {"$subtract": ["$tokens", cost]}, "$tokens"]}}}
+                ],
+                projection={"tokens": 1, "allowed": 1},
+                upsert=True,
+                return_document=ReturnDocument.AFTER
+            )
+        except PyMongoError as e:
+            # Se MongoDB non risponde si ammette la richiesta: il limite globale resta attivo
+            print(f"Errore del rate limiter condiviso: {str(e)}")
+            return 0
+        return 0 if bucket["allowed"] else (cost - bucket["tokens"]) / self.rate
+
+rate_limiter = (MongoTokenBucketLimiter if RATE_LIMIT_BACKEND == "mongo" else TokenBucketLimiter)(
+    RATE_LIMIT_RATE, RATE_LIMIT_BURST, RATE_LIMIT_KEYS
+)
+in_flight = {"active": 0, "limit": MAX_IN_FLIGHT}
+in_flight_lock = threading.Lock()
+
+def reject_request(reason, status_code, retry_after, message):
+    rejected_requests.inc(1, reason)
+    response = jsonify({"error": message})
+    response.headers["Retry-After"] = str(max(1, math.ceil(retry_after)))
+    return response, status_code
+
+@app.before_request
+def admit_request():
+    if request.endpoint in ADMISSION_EXEMPT_ENDPOINTS:
+        return None
+
+    # Prima il limite per API Key, così un tenant oltre quota non occupa posti globali
+    api_key = request.headers.get("X-API-KEY")
+    if RATE_LIMIT_ENABLED and api_key:
+        try:
+            # Si addebita solo una chiave esistente: ruotando chiavi inventate si avrebbe sempre un bucket pieno
+            # e si spingerebbero fuori dalla cache i bucket dei tenant reali
+            bucket = api_key if resolve_principal(api_key) else INVALID_API_KEY_BUCKET
+        except PyMongoError as e:
+            # Senza MongoDB l'API Key non è verificabile: la richiesta fallirà comunque nell'endpoint
+            print(f"Errore nella verifica dell'API Key per il rate limit: {str(e)}")
+            bucket = INVALID_API_KEY_BUCKET
+        retry_after = rate_limiter.acquire(bucket, RATE_LIMIT_WEIGHTS.get(request.endpoint, 1))
+        if retry_after:
+            return reject_request("rate_limit", 429, retry_after, "Troppe richieste per questa API Key, riprovare più tardi")
+
+    # Richiesta rimasta troppo a lungo nella coda di gunicorn: il client ha probabilmente già rinunciato
+    if MAX_QUEUE_WAIT_MS:
+        queue_wait = request_queue_wait_ms()
+        if queue_wait is not None and queue_wait > MAX_QUEUE_WAIT_MS:
+            return reject_request("queue_wait", 503, 1, "Server sovraccarico, riprovare più tardi")
+
+    # Oltre il limite si risponde subito invece di accodare la richiesta
+    with in_flight_lock:
+        if MAX_IN_FLIGHT and in_flight["active"] >= MAX_IN_FLIGHT:
+            overloaded = True
+        else:
+            overloaded = False
+            in_flight["active"] += 1
+    if overloaded:
+        return reject_request("overload", 503, 1, "Server sovraccarico, riprovare più tardi")
+    g.in_flight = True
+    return None
+
+@app.teardown_request
+def release_in_flight(exc):
+    # Per le risposte in streaming il teardown avviene a fine generazione
+    if g.pop("in_flight", False):
+        with in_flight_lock:
+            in_flight["active"] -= 1
+
+GaugeMetric(
+    "in_flight_requests", "Richieste in corso e limite del processo", ("kind",),
+    lambda: {(kind,): value for kind, value in in_flight.items()}
+)
+
+GaugeMetric(
+    "auth_cache_events", "Statistiche della cache delle API Key", ("event",),
+    lambda: {("size",): len(auth_cache), ("hits",): auth_cache.hits, ("misses",): auth_cache.misses}
+)
+
+GaugeMetric(
+    "distance_cache_events", "Statistiche della cache distanze", ("event",),
+    lambda: {(name,): value for name, value in get_distance_cache_stats().items()}
+)
+
+@app.route('/metrics', methods=['GET'])
+def metrics():
+    lines = []
+    for metric in METRICS:
+        lines.extend(metric.render())
+    return app.response_class("\n".join(lines) + "\n", mimetype="text/plain; version=0.0.4")
+
 @app.route('/')
 def home():
     return "Hello, Render!"
 
 if __name__ == '__main__':
-    app.run(debug=True, host='0.0.0.0', port=5000)
\ No newline at end of file
+    # Solo per lo sviluppo locale: in produzione si usa gunicorn (vedi Procfile)
+    create_app().run(debug=True, host='0.0.0.0', port=int(os.getenv("PORT", "5000")))
\ No newline at end of file
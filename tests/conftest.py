@@ -0,0 +1,76 @@
+# -*- coding: utf-8 -*-
+"""Fixture comuni: MongoDB sostituito da mongomock e un Airport Gap finto locale.
+
+Dipendenze dei test (non dell'app): pip install -r requirements-dev.txt
+"""
+import os
+import sys
+import threading
+from http.server import ThreadingHTTPServer
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+os.environ["MONGO_URI"] = "mongodb://localhost:27017"
+os.environ.setdefault("AIRPORT_GAP_API_KEY", "test")
+os.environ["AUTH_CACHE_WATCH"] = "0"  # mongomock non supporta le change stream
+os.environ["RATE_LIMIT_ENABLED"] = "0"
+
+mongomock = pytest.importorskip("mongomock")
+import mongomock.gridfs  # noqa: E402
+
+mongomock.gridfs.enable_gridfs_integration()
+mongomock.patch(servers=(("localhost", 27017),)).start()
+
+import server  # noqa: E402
+from tests.fake_airport_gap import make_stub_handler  # noqa: E402
+
+
+@pytest.fixture
+def app(monkeypatch):
+    server.create_app()
+    for name in server.db.list_collection_names():
+        server.db.drop_collection(name)
+    server.ensure_indexes()
+    server.auth_cache.clear()
+    server.distance_lru.clear()
+    server.distance_failures.clear()
+    monkeypatch.setattr(server, "airport_gap_breaker", server.CircuitBreaker(
+        server.AIRPORT_GAP_BREAKER_THRESHOLD, server.AIRPORT_GAP_BREAKER_COOLDOWN))
+    return server.app
+
+
+@pytest.fixture
+def client(app):
+    return app.test_client()
+
+
+@pytest.fixture
+def airport_gap(monkeypatch):
+    """Avvia un Airport Gap finto (opzioni di make_stub_handler) e vi punta il server."""
+    servers = []
+
+    def start(latency=0.0, **options):
+        handler = make_stub_handler(latency, **options)
+        httpd = ThreadingHTTPServer(("127.0.0.1", 0), handler)
+        httpd.daemon_threads = True
+        threading.Thread(target=httpd.serve_forever, daemon=True).start()
+        servers.append(httpd)
+        monkeypatch.setattr(server, "AIRPORT_GAP_URL", f"http://127.0.0.1:{httpd.server_port}/api/airports/distance")
+        return handler
+
+    yield start
+    for httpd in servers:
+        httpd.shutdown()
+        httpd.server_close()
+
+
+@pytest.fixture
+def tenant(client):
+    """Utente associato al cliente "ACME": restituisce gli header con la sua API Key."""
+    user = client.post("/create_user", json={"username": "mario", "email": "mario@example.com"}).json["user"]
+    client.post("/create_client", json={"nome": "ACME"})
+    client.post("/associate_user_to_client", json={"nome_cliente": "ACME", "username": "mario"})
+    return {"X-API-KEY": user["api_key"]}
@@ -0,0 +1,45 @@
+# -*- coding: utf-8 -*-
+"""Airport Gap finto per i test e i benchmark: nessuna dipendenza da server.py né dall'ambiente."""
+import json
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler
+
+
+def make_stub_handler(latency, error_rate=0.0, error_status=503, unknown_codes=(), retry_after=None, fail_first=0):
+    """Airport Gap finto: latenza fissa, una quota di risposte di errore e codici IATA sconosciuti (422).
+
+    Con retry_after le risposte di errore includono l'header Retry-After; le prime fail_first
+    richieste rispondono sempre con error_status.
+    """
+    rng = random.Random(1)
+    lock = threading.Lock()
+
+    class StubAirportGap(BaseHTTPRequestHandler):
+        calls = 0  # Richieste ricevute, per verificare retry e circuit breaker
+
+        def do_POST(self):
+            with lock:
+                StubAirportGap.calls += 1
+                forced_error = StubAirportGap.calls <= fail_first
+            payload = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+            time.sleep(latency)
+            if payload.get("from") in unknown_codes or payload.get("to") in unknown_codes:
+                status, body = 422, b'{"errors": [{"detail": "Airport not found"}]}'
+            elif forced_error or rng.random() < error_rate:
+                status, body = error_status, b'{"errors": [{"detail": "Service unavailable"}]}'
+            else:
+                status, body = 200, json.dumps({"data": {"attributes": {"kilometers": 1234.5}}}).encode()
+            self.send_response(status)
+            if retry_after is not None and status not in (200, 422):
+                self.send_header("Retry-After", str(retry_after))
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    return StubAirportGap
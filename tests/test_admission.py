@@ -0,0 +1,70 @@
+# -*- coding: utf-8 -*-
+"""Controllo di ammissione: attesa in coda, limite di richieste in corso e token bucket per API Key."""
+import time
+
+import server
+
+
+def test_request_waiting_too_long_in_queue_is_shed(client, monkeypatch):
+    monkeypatch.setattr(server, "MAX_QUEUE_WAIT_MS", 500)
+    now_ms = int(time.time() * 1000)
+
+    stale = client.get("/get_user_files", headers={"X-Request-Start": f"t={now_ms - 2000}"})
+    assert stale.status_code == 503
+    assert stale.headers["Retry-After"] == "1"
+
+    fresh = client.get("/get_user_files", headers={"X-Request-Start": f"t={now_ms}"})
+    assert fresh.status_code == 401
+    # Formato nginx in secondi con decimali
+    assert client.get("/get_user_files", headers={"X-Request-Start": f"t={time.time() - 2:.3f}"}).status_code == 503
+    assert client.get("/get_user_files", headers={"X-Request-Start": "sconosciuto"}).status_code == 401
+
+
+def test_in_flight_limit_rejects_with_503(client, monkeypatch):
+    monkeypatch.setattr(server, "MAX_IN_FLIGHT", 1)
+    monkeypatch.setitem(server.in_flight, "active", 1)
+    response = client.get("/get_user_files")
+    assert response.status_code == 503
+    # Il monitoraggio non è mai rifiutato
+    assert client.get("/metrics").status_code == 200
+
+
+def test_mongo_buckets_expire_per_document(app, monkeypatch):
+    monkeypatch.setattr(server, "RATE_LIMIT_BACKEND", "mongo")
+    # Indice creato da una versione precedente con un'altra durata
+    server.rate_limits_collection.create_index("updated_at", expireAfterSeconds=3600)
+    server.ensure_indexes()
+    indexes = server.rate_limits_collection.index_information()
+    assert "updated_at_1" not in indexes
+    assert indexes["expires_at_1"]["expireAfterSeconds"] == 0
+
+    # Ricarica più lenta di quella di default: il bucket deve durare quanto serve a questo limiter
+    limiter = server.MongoTokenBucketLimiter(0.1, 2, 10)
+    assert limiter.acquire("chiave", 1) == 0
+    assert limiter.acquire("chiave", 1) == 0
+    assert limiter.acquire("chiave", 1) > 0
+    bucket = server.rate_limits_collection.find_one({"_id": "chiave"})
+    assert (bucket["expires_at"] - bucket["updated_at"]).total_seconds() == limiter.idle_seconds == 20
+
+
+def test_memory_backend_creates_no_rate_limit_index(app):
+    assert "expires_at_1" not in server.rate_limits_collection.index_information()
+
+
+def test_only_valid_api_keys_get_their_own_bucket(client, tenant, monkeypatch):
+    limiter = server.TokenBucketLimiter(0.001, 2, 100)
+    monkeypatch.setattr(server, "RATE_LIMIT_ENABLED", True)
+    monkeypatch.setattr(server, "rate_limiter", limiter)
+
+    # Ogni chiave inventata consuma lo stesso bucket condiviso
+    assert client.get("/get_user_files", headers={"X-API-KEY": "falsa-1"}).status_code == 401
+    assert client.get("/get_user_files", headers={"X-API-KEY": "falsa-2"}).status_code == 401
+    rejected = client.get("/get_user_files", headers={"X-API-KEY": "falsa-3"})
+    assert rejected.status_code == 429
+    assert len(limiter.buckets) == 1
+
+    # La chiave valida ha il proprio bucket, non toccato dalle chiavi non valide
+    assert client.get("/get_user_files", headers=tenant).status_code == 200
+    assert client.get("/get_user_files", headers=tenant).status_code == 200
+    assert client.get("/get_user_files", headers=tenant).status_code == 429
+    assert len(limiter.buckets) == 2
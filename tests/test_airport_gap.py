@@ -0,0 +1,133 @@
+# -*- coding: utf-8 -*-
+"""Client Airport Gap contro un server finto che inietta latenza ed errori."""
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+import server
+
+
+@pytest.fixture(autouse=True)
+def fast_retries(app, monkeypatch):
+    monkeypatch.setattr(server, "AIRPORT_GAP_RETRIES", 2)
+    monkeypatch.setattr(server, "AIRPORT_GAP_BACKOFF", 0.01)
+    monkeypatch.setattr(server, "AIRPORT_GAP_TIMEOUT", (1, 0.2))
+
+
+def test_success(airport_gap):
+    handler = airport_gap()
+    assert server.get_distance_with_api("MXP", "FCO") == 1234.5
+    assert handler.calls == 1
+
+
+def test_read_timeout_is_retried_then_fails(airport_gap):
+    handler = airport_gap(latency=0.5)
+    start = time.perf_counter()
+    with pytest.raises(Exception):
+        server.get_distance_with_api("MXP", "FCO")
+    # Un tentativo più AIRPORT_GAP_RETRIES, ognuno interrotto dal timeout di lettura
+    assert handler.calls == 3
+    assert time.perf_counter() - start < 1.5
+
+
+def test_server_errors_are_retried(airport_gap):
+    handler = airport_gap(fail_first=2, error_status=503)
+    assert server.get_distance_with_api("MXP", "FCO") == 1234.5
+    assert handler.calls == 3
+    assert not server.airport_gap_breaker.is_open()
+
+
+def test_breaker_opens_and_fails_fast(airport_gap, monkeypatch):
+    monkeypatch.setattr(server, "AIRPORT_GAP_RETRIES", 0)
+    monkeypatch.setattr(server, "airport_gap_breaker", server.CircuitBreaker(2, 60))
+    handler = airport_gap(error_rate=1.0, error_status=503)
+    for _ in range(2):
+        with pytest.raises(Exception):
+            server.get_distance_with_api("MXP", "FCO")
+    assert server.airport_gap_breaker.is_open()
+
+    with pytest.raises(Exception, match="circuito aperto"):
+        server.get_distance_with_api("MXP", "FCO")
+    assert handler.calls == 2
+    assert server.airport_gap_breaker.rejected == 1
+
+
+def test_breaker_half_open_probe(airport_gap, monkeypatch):
+    monkeypatch.setattr(server, "AIRPORT_GAP_RETRIES", 0)
+    monkeypatch.setattr(server, "airport_gap_breaker", server.CircuitBreaker(1, 0.2))
+    airport_gap(error_rate=1.0, error_status=503)
+    with pytest.raises(Exception):
+        server.get_distance_with_api("MXP", "FCO")
+    assert server.airport_gap_breaker.is_open()
+
+    # Dopo il cooldown una sola chiamata di prova: se fallisce il circuito si riapre
+    time.sleep(0.25)
+    with pytest.raises(Exception):
+        server.get_distance_with_api("MXP", "FCO")
+    assert server.airport_gap_breaker.is_open()
+    with pytest.raises(Exception, match="circuito aperto"):
+        server.get_distance_with_api("MXP", "FCO")
+
+    # Se la prova riesce il circuito si chiude
+    handler = airport_gap()
+    time.sleep(0.25)
+    assert server.get_distance_with_api("MXP", "FCO") == 1234.5
+    assert not server.airport_gap_breaker.is_open()
+    assert handler.calls == 1
+
+
+def test_unknown_route_is_negative_cached(airport_gap):
+    handler = airport_gap(unknown_codes=("ZZZ",))
+    for _ in range(3):
+        with pytest.raises(server.AirportGapError):
+            server.get_distance_with_api("MXP", "ZZZ")
+    assert handler.calls == 1
+    assert not server.airport_gap_breaker.is_open()
+    # Le altre tratte non sono toccate dalla cache negativa
+    assert server.get_distance_with_api("MXP", "FCO") == 1234.5
+
+
+def test_unauthorized_trips_breaker_without_negative_cache(airport_gap, monkeypatch):
+    monkeypatch.setattr(server, "airport_gap_breaker", server.CircuitBreaker(2, 60))
+    handler = airport_gap(error_rate=1.0, error_status=401)
+    for _ in range(2):
+        with pytest.raises(Exception) as error:
+            server.get_distance_with_api("MXP", "FCO")
+        assert not isinstance(error.value, server.AirportGapError)
+    # Nessun retry su 401: una richiesta per chiamata
+    assert handler.calls == 2
+    assert server.airport_gap_breaker.is_open()
+    assert len(server.distance_failures) == 0
+
+
+def test_rate_limit_honours_retry_after(airport_gap):
+    handler = airport_gap(fail_first=1, error_status=429, retry_after="0.3")
+    start = time.perf_counter()
+    assert server.get_distance_with_api("MXP", "FCO") == 1234.5
+    assert time.perf_counter() - start >= 0.3
+    assert handler.calls == 2
+    assert server.airport_gap_breaker.failures == 0
+
+
+def test_rate_limit_with_long_retry_after_gives_up(airport_gap):
+    handler = airport_gap(error_rate=1.0, error_status=429, retry_after="120")
+    with pytest.raises(Exception):
+        server.get_distance_with_api("MXP", "FCO")
+    assert handler.calls == 1
+    assert not server.airport_gap_breaker.is_open()
+
+
+def test_distance_cache_counters_under_concurrency(airport_gap, monkeypatch):
+    handler = airport_gap()
+    server.get_cached_distance("MXP", "FCO")
+    assert handler.calls == 1
+    before = server.get_distance_cache_stats()
+    # Senza LRU ogni lettura arriva alla cache MongoDB, dai thread del pool come in produzione
+    monkeypatch.setattr(server.distance_lru, "get", lambda key: None)
+
+    with ThreadPoolExecutor(max_workers=server.AIRPORT_GAP_MAX_WORKERS) as pool:
+        distances = list(pool.map(lambda _: server.get_cached_distance("FCO", "MXP"), range(400)))
+    assert set(distances) == {1234.5}
+    assert handler.calls == 1
+    assert server.get_distance_cache_stats()["mongo_hits"] - before["mongo_hits"] == 400
@@ -0,0 +1,28 @@
+# -*- coding: utf-8 -*-
+"""Tabella aeroporti in memoria: distanze ortodromiche e ricarica."""
+import pytest
+
+import server
+
+MXP = {"iata": "MXP", "latitude": 45.6306, "longitude": 8.7281}
+FCO = {"iata": "FCO", "latitude": 41.8003, "longitude": 12.2389}
+
+
+def test_distances_and_unknown_codes():
+    table = server.AirportTable()
+    assert table.load([MXP, FCO, {"iata": "XXX", "latitude": "n/d", "longitude": 0}, {"latitude": 1}]) == 2
+    mxp_fco, unknown = table.distances([(" mxp", "FCO"), ("MXP", "XXX")])
+    assert mxp_fco == pytest.approx(509, abs=2)
+    assert unknown is None
+
+
+def test_reload_replaces_the_whole_table_at_once():
+    table = server.AirportTable()
+    table.load([MXP, FCO])
+    before = table.table
+    # La nuova tabella ha meno codici: indice e coordinate devono cambiare insieme
+    table.load([FCO])
+    assert table.table is not before
+    index, lat, lon = table.table
+    assert index == {"FCO": 0} and len(lat) == len(lon) == 1
+    assert table.distances([("MXP", "FCO"), ("FCO", "FCO")]) == [None, 0.0]
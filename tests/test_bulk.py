@@ -0,0 +1,49 @@
+# -*- coding: utf-8 -*-
+"""Import NDJSON di /add_energy_data/bulk: esito per riga e rollup coerenti con i documenti salvati."""
+import json
+
+import server
+
+
+def travel(anno, document_name, origin="MXP", destination="FCO"):
+    return {
+        "anno": anno,
+        "document_type": "BUSINESS_TRAVEL",
+        "dati": [{"document_name": document_name, "date": f"{anno}-03-01",
+                  "travel": {"from": origin, "to": destination}, "num_of_travelers": 1}],
+    }
+
+
+def post_bulk(client, headers, records):
+    body = "".join((record if isinstance(record, str) else json.dumps(record)) + "\n" for record in records)
+    response = client.post("/add_energy_data/bulk", headers=headers, data=body,
+                           content_type="application/x-ndjson")
+    assert response.status_code == 200
+    lines = [json.loads(line) for line in response.get_data(as_text=True).splitlines()]
+    return lines[:-1], lines[-1]["summary"]
+
+
+def test_bulk_reports_each_line(client, tenant, airport_gap):
+    airport_gap()
+    results, summary = post_bulk(client, tenant, [travel(2024, "a.pdf"), "{non json", travel(2023, "b.pdf")])
+    assert [result["status"] for result in results] == [201, 400, 201]
+    assert [result["line"] for result in results] == [1, 2, 3]
+    assert summary == {"records": 3, "inserted": 2, "errors": 1}
+    assert server.rollups_collection.count_documents({}) == 2
+
+
+def test_bulk_write_errors_are_reported_per_line(client, tenant, airport_gap):
+    airport_gap()
+    # Un solo documento per cliente e anno: il secondo record del 2024 viene rifiutato dal database
+    server.snapshots_collection.create_index([("cliente_id", 1), ("anno", 1)], unique=True)
+
+    results, summary = post_bulk(client, tenant, [travel(2024, "a.pdf"), travel(2024, "b.pdf"), travel(2023, "c.pdf")])
+    assert [result["status"] for result in results] == [201, 500, 201]
+    assert results[1]["error"].startswith("Salvataggio non riuscito")
+    assert "value" not in results[1]
+    assert summary == {"records": 3, "inserted": 2, "errors": 1}
+
+    # Il rollup conta solo i documenti salvati
+    rollup = server.rollups_collection.find_one({"nome": "ACME", "anno": 2024})
+    assert rollup["documents"] == 1
+    assert rollup["value"] == results[0]["value"]
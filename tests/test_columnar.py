@@ -0,0 +1,110 @@
+# -*- coding: utf-8 -*-
+"""Elaborazione colonnare di GAS/ELECTRICITY: stessi risultati ed eccezioni della versione per righe."""
+import random
+
+import pytest
+
+import server
+
+ANNO = 2024
+
+PROCESSORS = {
+    "consumption_sMc": (server.process_gas_items_with_notes, server.process_gas_items_columnar),
+    "total_electricity_consumption": (server.process_electricity_items_with_notes,
+                                      server.process_electricity_items_columnar),
+}
+
+DATES = [
+    "2023-12-31", "2024-01-01", "2024-06-15", "2024-12-31", "2025-01-01",
+    "2024-1-5",  # Accettata da strptime anche senza zeri iniziali
+    "2024-02-29", "2023-02-29", "2024-02-30", "2024-13-01", "2024/01/01", " 2024-01-01", "2024-01-01 ",
+    "２０２４-01-01", "",
+]
+# Valori i cui totali cambiano con l'ordine o con la somma compensata
+VALUES = [0.1, 0.2, 0.3, 1.005, 2.675, 1e16, -1e16, 1.0, 123.456, 0, 7]
+
+
+def outcome(function, items):
+    try:
+        return "ok", function(items, ANNO)
+    except Exception as e:
+        return "error", type(e), str(e)
+
+
+def compare(items, value_key, monkeypatch):
+    row_function, columnar_function = PROCESSORS[value_key]
+    # Forza la versione per righe disattivando la soglia colonnare
+    monkeypatch.setattr(server, "COLUMNAR_MIN_ITEMS", float("inf"))
+    expected = outcome(row_function, items)
+    assert outcome(columnar_function, items) == expected
+    return expected
+
+
+def make_item(i, value_key, start, end, value):
+    return {"document_name": f"doc_{i}.pdf", "period": {"start_date": start, "end_date": end}, value_key: {"value": value}}
+
+
+@pytest.mark.parametrize("value_key", PROCESSORS)
+def test_valid_and_discarded_items(value_key, monkeypatch):
+    items = [
+        make_item(0, value_key, "2024-01-01", "2024-01-31", 0.1),
+        make_item(1, value_key, "2023-12-01", "2024-01-10", 0.2),
+        make_item(2, value_key, "2024-12-01", "2025-01-10", 0.3),
+        make_item(3, value_key, "2024-02-01", "", 5),
+        {"document_name": "senza_periodo.pdf", value_key: {"value": 1}},
+        {"document_name": "senza_fine.pdf", "period": {"start_date": "2024-01-01"}, value_key: {"value": 1}},
+        make_item(4, value_key, "2024-1-5", "2024-2-5", 2.675),
+        make_item(5, value_key, "2022-01-01", "2022-12-31", 1000),
+    ]
+    status, (valid, total, discarded) = compare(items, value_key, monkeypatch)
+    assert status == "ok"
+    assert discarded == ["doc_3.pdf", "senza_periodo.pdf", "senza_fine.pdf"]
+    assert valid
+
+
+@pytest.mark.parametrize("value_key", PROCESSORS)
+def test_totals_round_like_the_row_version(value_key, monkeypatch):
+    # Somma sequenziale: 1e16 + 1.0 - 1e16 dà 0.0, una somma compensata darebbe 1.0
+    values = [1e16, 1.0, -1e16, 1.005, 0.1, 0.2]
+    items = [make_item(i, value_key, "2024-03-01", "2024-03-31", value) for i, value in enumerate(values)]
+    status, (_, total, _) = compare(items, value_key, monkeypatch)
+    assert status == "ok"
+
+
+@pytest.mark.parametrize("value_key", PROCESSORS)
+@pytest.mark.parametrize("bad_date", ["2024-02-30", "2024/01/01", " 2024-01-01", "２０２４-01-01", "2024-13-01"])
+def test_invalid_dates(value_key, bad_date, monkeypatch):
+    items = [
+        make_item(0, value_key, "2024-01-01", "2024-01-31", 1),
+        make_item(1, value_key, "2024-02-01", bad_date, 2),
+        make_item(2, value_key, bad_date, "2024-03-31", 3),
+    ]
+    # Il gas interrompe l'elaborazione con il ValueError di strptime, l'elettricità scarta il documento
+    compare(items, value_key, monkeypatch)
+
+
+@pytest.mark.parametrize("value_key", PROCESSORS)
+def test_errors_are_raised_in_item_order(value_key, monkeypatch):
+    missing_value = {"document_name": "senza_valore.pdf", "period": {"start_date": "2024-01-01", "end_date": "2024-01-31"}}
+    compare([missing_value, make_item(1, value_key, "2024-02-30", "2024-03-01", 1)], value_key, monkeypatch)
+    compare([make_item(0, value_key, "2024-02-30", "2024-03-01", 1), missing_value], value_key, monkeypatch)
+    compare([missing_value, make_item(1, value_key, 20240101, "2024-03-01", 1)], value_key, monkeypatch)
+    compare([missing_value, make_item(1, value_key, ["2024-01-01"], "2024-03-01", 1)], value_key, monkeypatch)
+    compare([missing_value, {"document_name": "periodo.pdf", "period": 5}], value_key, monkeypatch)
+    compare([make_item(0, value_key, "2024-02-30", 20240101, 1), missing_value], value_key, monkeypatch)
+
+
+@pytest.mark.parametrize("value_key", PROCESSORS)
+def test_random_payloads(value_key, monkeypatch):
+    rng = random.Random(11)
+    for _ in range(300):
+        items = []
+        for i in range(rng.randint(0, 25)):
+            item = make_item(i, value_key, rng.choice(DATES), rng.choice(DATES), rng.choice(VALUES))
+            roll = rng.random()
+            if roll < 0.05:
+                del item["period"]
+            elif roll < 0.1:
+                del item["period"]["end_date"]
+            items.append(item)
+        compare(items, value_key, monkeypatch)
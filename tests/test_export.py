@@ -0,0 +1,43 @@
+# -*- coding: utf-8 -*-
+"""Export in streaming dello storico di un cliente e negoziazione della compressione."""
+import gzip
+import json
+
+import pytest
+
+PAYLOAD = {
+    "anno": 2024,
+    "document_type": "BUSINESS_TRAVEL",
+    "dati": [
+        {"document_name": "volo_1.pdf", "date": "2024-03-01", "travel": {"from": "MXP", "to": "FCO"}, "num_of_travelers": 2},
+        {"document_name": "volo_2.pdf", "date": "2024-05-10", "travel": {"from": "FCO", "to": "JFK"}, "num_of_travelers": 1},
+    ],
+}
+
+
+@pytest.fixture
+def history(client, tenant, airport_gap):
+    airport_gap()
+    assert client.post("/add_energy_data", headers=tenant, json=PAYLOAD).status_code == 201
+    return tenant
+
+
+@pytest.mark.parametrize("accept_encoding, compressed", [
+    ("gzip", True),
+    ("br, gzip;q=0.5", True),
+    ("*", True),
+    ("gzip;q=0, br", False),
+    ("identity", False),
+    (None, False),
+])
+def test_export_gzip_honours_quality(client, history, accept_encoding, compressed):
+    headers = dict(history)
+    if accept_encoding is not None:
+        headers["Accept-Encoding"] = accept_encoding
+    response = client.get("/export_client_data", headers=headers, query_string={"nome": "ACME"})
+    assert response.status_code == 200
+    assert (response.headers.get("Content-Encoding") == "gzip") is compressed
+    body = gzip.decompress(response.data) if compressed else response.data
+    rows = [json.loads(line) for line in body.decode("utf-8").splitlines()]
+    assert len(rows) == 2
+    assert {row["document_type"] for row in rows} == {"BUSINESS_TRAVEL"}
@@ -0,0 +1,99 @@
+# -*- coding: utf-8 -*-
+"""Modalità asincrona di /add_energy_data: job, coda piena e ripresa dopo un riavvio."""
+import threading
+import time
+from datetime import datetime, timedelta
+
+import pytest
+
+import server
+
+PAYLOAD = {
+    "anno": 2024,
+    "document_type": "BUSINESS_TRAVEL",
+    "dati": [
+        {"document_name": "volo_1.pdf", "date": "2024-03-01", "travel": {"from": "MXP", "to": "FCO"}, "num_of_travelers": 2},
+        {"document_name": "volo_2.pdf", "date": "2024-05-10", "travel": {"from": "FCO", "to": "JFK"}, "num_of_travelers": 1},
+        {"document_name": "volo_2023.pdf", "date": "2023-05-10", "travel": {"from": "FCO", "to": "JFK"}, "num_of_travelers": 1},
+    ],
+}
+
+
+def wait_for_job(client, headers, job_id, timeout=5):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        response = client.get(f"/jobs/{job_id}", headers=headers)
+        if response.status_code != 202:
+            return response
+        time.sleep(0.02)
+    pytest.fail(f"Job {job_id} non concluso entro {timeout} s")
+
+
+def test_async_job_matches_sync_response(client, tenant, airport_gap):
+    handler = airport_gap(latency=0.01)
+    sync = client.post("/add_energy_data", headers=tenant, json=PAYLOAD)
+    assert sync.status_code == 201
+    assert handler.calls == 2
+
+    accepted = client.post("/add_energy_data?async=1", headers=tenant, json=PAYLOAD)
+    assert accepted.status_code == 202
+    assert accepted.json["status_url"] == f"/jobs/{accepted.json['job_id']}"
+
+    result = wait_for_job(client, tenant, accepted.json["job_id"])
+    assert result.status_code == sync.status_code
+    assert result.json == sync.json
+    assert server.snapshots_collection.count_documents({}) == 2
+
+
+def test_async_job_reports_validation_errors(client, tenant):
+    accepted = client.post("/add_energy_data", headers={**tenant, "Prefer": "respond-async"},
+                           json={**PAYLOAD, "anno": "duemila"})
+    assert accepted.status_code == 400
+
+
+def test_full_queue_returns_503(client, tenant, monkeypatch):
+    slots = threading.BoundedSemaphore(1)
+    slots.acquire()
+    monkeypatch.setattr(server, "job_slots", slots)
+
+    response = client.post("/add_energy_data?async=1", headers=tenant, json=PAYLOAD)
+    assert response.status_code == 503
+    assert response.headers["Retry-After"]
+    assert server.jobs_collection.count_documents({}) == 0
+
+
+def test_recover_jobs_requeues_pending_and_stale_jobs(client, tenant, airport_gap):
+    airport_gap()
+    user = server.users_collection.find_one({"api_key": tenant["X-API-KEY"]})
+    cliente = server.client_collection.find_one({"nome": "ACME"})
+    now = datetime.utcnow()
+
+    def insert_job(status, updated_at):
+        return server.jobs_collection.insert_one({
+            "status": status, "user_id": user["_id"], "cliente_id": cliente["_id"], "data": PAYLOAD,
+            "worker": "altro-worker", "created_at": now, "started_at": now - timedelta(hours=1), "updated_at": updated_at
+        }).inserted_id
+
+    queued = insert_job("queued", now)
+    # Worker morto: heartbeat fermo da più di JOB_STALE_SECONDS
+    stale = insert_job("running", now - timedelta(seconds=server.JOB_STALE_SECONDS + 60))
+    # Job lungo ancora vivo su un altro worker: heartbeat recente, non va duplicato
+    alive = insert_job("running", now)
+
+    server.recover_jobs()
+
+    for job_id in (queued, stale):
+        result = wait_for_job(client, tenant, str(job_id))
+        assert result.status_code == 201
+    assert server.jobs_collection.find_one({"_id": alive})["status"] == "running"
+    assert server.snapshots_collection.count_documents({}) == 2
+
+
+def test_job_records_the_pid_of_the_process_running_it(client, tenant, airport_gap, monkeypatch):
+    airport_gap()
+    # Processo figlio di gunicorn (preload_app): il PID non è quello del master che ha importato il modulo
+    monkeypatch.setattr(server.os, "getpid", lambda: 4242)
+    accepted = client.post("/add_energy_data?async=1", headers=tenant, json=PAYLOAD)
+    assert wait_for_job(client, tenant, accepted.json["job_id"]).status_code == 201
+    job = server.jobs_collection.find_one({"_id": server.ObjectId(accepted.json["job_id"])})
+    assert job["worker"].endswith("-4242")
@@ -0,0 +1,40 @@
+# -*- coding: utf-8 -*-
+"""Provider JSON: stesso risultato del provider standard di Flask anche dove orjson non arriva."""
+import json
+import math
+from datetime import datetime
+
+import pytest
+from bson.objectid import ObjectId
+from flask.json.provider import DefaultJSONProvider
+
+
+
+@pytest.fixture
+def provider(app):
+    return app.json
+
+
+def test_big_integers_round_trip(provider):
+    assert json.loads(provider.dumps({"a": 2 ** 70})) == {"a": 2 ** 70}
+    assert provider.loads('{"a": 1180591620717411303424}') == {"a": 2 ** 70}
+    assert provider.loads(b'[18446744073709551616, -9223372036854775809]') == [2 ** 64, -(2 ** 63) - 1]
+    assert provider.loads('{"a": 12}') == {"a": 12}
+
+
+def test_nan_is_accepted_like_the_standard_provider(provider):
+    assert math.isnan(provider.loads('{"a": NaN}')["a"])
+    with pytest.raises(ValueError):
+        provider.loads('{"a": ')
+
+
+def test_response_with_big_integer(client, app):
+    with app.test_request_context():
+        response = app.json.response({"value": 2 ** 70, "id": ObjectId("0123456789abcdef01234567")})
+    assert json.loads(response.get_data()) == {"value": 2 ** 70, "id": "0123456789abcdef01234567"}
+
+
+def test_dates_match_the_default_provider(provider, app):
+    value = {"timestamp": datetime(2024, 1, 1)}
+    assert json.loads(provider.dumps(value)) == json.loads(DefaultJSONProvider(app).dumps(value))
+
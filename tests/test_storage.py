@@ -0,0 +1,41 @@
+# -*- coding: utf-8 -*-
+"""Contatori di /stats/storage: aggiornati a ogni upload e ricostruibili con "flask rebuild-storage-stats"."""
+from io import BytesIO
+
+import server
+
+
+def upload(client, headers, name, content):
+    response = client.post("/upload", headers=headers, content_type="multipart/form-data",
+                           data={"file": (BytesIO(content), name, "application/pdf")})
+    assert response.status_code == 200
+    return response
+
+
+def test_storage_stats_count_logical_and_stored_bytes(client, tenant):
+    assert client.get("/stats/storage").json["files"] == 0
+
+    upload(client, tenant, "a.pdf", b"x" * 100)
+    upload(client, tenant, "copia.pdf", b"x" * 100)
+    upload(client, tenant, "b.pdf", b"y" * 50)
+
+    stats = client.get("/stats/storage").json
+    assert stats == {"files": 3, "unique_blobs": 2, "logical_bytes": 250, "stored_bytes": 150, "dedup_ratio": 1.67}
+
+    # Il ricalcolo completo dà gli stessi valori dei contatori incrementali
+    server.storage_stats_collection.delete_many({})
+    result = server.app.test_cli_runner().invoke(args=["rebuild-storage-stats"])
+    assert result.exit_code == 0, result.output
+    assert client.get("/stats/storage").json == stats
+
+
+def test_truncated_multipart_body_is_rejected(client, tenant):
+    body = (b"--limite\r\n"
+            b'Content-Disposition: form-data; name="file"; filename="a.pdf"\r\n'
+            b"Content-Type: application/pdf\r\n\r\n"
+            b"%PDF contenuto senza chiusura")
+    response = client.post("/upload", headers=tenant, data=body,
+                           content_type="multipart/form-data; boundary=limite")
+    assert response.status_code == 400
+    assert response.json == {"error": "Nessun file trovato nella richiesta"}
+    assert server.files_collection.count_documents({}) == 0
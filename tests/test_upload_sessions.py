@@ -0,0 +1,97 @@
+# -*- coding: utf-8 -*-
+"""Upload riprendibili a blocchi: validazione della sessione e completamento."""
+from datetime import datetime, timedelta
+
+import pytest
+from bson.objectid import ObjectId
+
+import server
+
+
+@pytest.mark.parametrize("body", [
+    ["filename", "content_type"],
+    "report.pdf",
+    {"filename": "report.pdf"},
+    {"filename": "report.pdf", "content_type": ["application/pdf"]},
+    {"filename": {"nome": "report.pdf"}, "content_type": "application/pdf"},
+    {"filename": "report.pdf", "content_type": "application/pdf", "size": True},
+    {"filename": "report.pdf", "content_type": "application/pdf", "size": -1},
+    {"filename": "report.pdf", "content_type": "application/pdf", "size": 1.5},
+])
+def test_create_session_rejects_invalid_body(client, tenant, body):
+    response = client.post("/upload_sessions", headers=tenant, json=body)
+    assert response.status_code == 400
+    assert server.upload_sessions_collection.count_documents({}) == 0
+
+
+def test_create_session(client, tenant):
+    response = client.post("/upload_sessions", headers=tenant,
+                           json={"filename": "report.pdf", "content_type": "application/pdf", "size": 0})
+    assert response.status_code == 201
+    assert response.json["status"] == "open"
+
+
+def open_session_with_chunk(client, headers, content):
+    upload_id = client.post("/upload_sessions", headers=headers,
+                            json={"filename": "report.pdf", "content_type": "application/pdf",
+                                  "size": len(content)}).json["upload_id"]
+    assert client.put(f"/upload_sessions/{upload_id}/chunks/0", headers=headers, data=content).status_code in (200, 201)
+    return upload_id
+
+
+def test_stuck_completion_can_be_retried_once_stale(client, tenant):
+    upload_id = open_session_with_chunk(client, tenant, b"%PDF contenuto")
+    # Completamento avviato da un processo terminato a metà
+    completing_at = datetime.utcnow()
+    server.upload_sessions_collection.update_one(
+        {"_id": ObjectId(upload_id)}, {"$set": {"status": "completing", "completing_at": completing_at}})
+
+    assert client.post(f"/upload_sessions/{upload_id}/complete", headers=tenant).status_code == 409
+
+    server.upload_sessions_collection.update_one(
+        {"_id": ObjectId(upload_id)},
+        {"$set": {"completing_at": completing_at - timedelta(seconds=server.UPLOAD_SESSION_COMPLETING_STALE + 1)}})
+    response = client.post(f"/upload_sessions/{upload_id}/complete", headers=tenant)
+    assert response.status_code == 200
+    file_id = response.json["uploaded_files"][0]["file_id"]
+
+    session = client.get(f"/upload_sessions/{upload_id}", headers=tenant).json
+    assert session["status"] == "completed"
+    download = client.get("/download", headers=tenant, query_string={"file_id": file_id})
+    assert download.data == b"%PDF contenuto"
+    # Una seconda chiamata restituisce lo stesso file
+    again = client.post(f"/upload_sessions/{upload_id}/complete", headers=tenant)
+    assert again.json["uploaded_files"][0]["file_id"] == file_id
+
+
+def test_chunk_put_racing_completion_is_discarded(client, tenant, monkeypatch):
+    upload_id = open_session_with_chunk(client, tenant, b"%PDF contenuto")
+    # Il PUT ha letto la sessione ancora aperta prima di ricevere il corpo; intanto parte il completamento
+    session = server.upload_sessions_collection.find_one({"_id": ObjectId(upload_id)})
+    server.upload_sessions_collection.update_one({"_id": session["_id"]}, {"$set": {"status": "completing"}})
+    monkeypatch.setattr(server, "get_upload_session", lambda user, upload_id: (session, None, None))
+
+    response = client.put(f"/upload_sessions/{upload_id}/chunks/1", headers=tenant, data=b"in ritardo")
+    assert response.status_code == 409
+    assert server.upload_chunks_collection.count_documents({"session_id": session["_id"], "index": 1}) == 0
+
+
+def test_chunk_replaced_while_completing_aborts_completion(client, tenant, monkeypatch):
+    upload_id = open_session_with_chunk(client, tenant, b"%PDF prima parte ")
+    assert client.put(f"/upload_sessions/{upload_id}/chunks/1", headers=tenant, data=b"seconda parte").status_code == 200
+    server.upload_sessions_collection.update_one({"_id": ObjectId(upload_id)}, {"$unset": {"size": ""}})
+
+    find = server.upload_chunks_collection.find
+
+    def find_and_swap(query, projection=None):
+        # Un PUT concorrente sostituisce il blocco 1 dopo che il completamento ne ha letto l'elenco
+        if projection and "data" in projection:
+            server.upload_chunks_collection.update_one(
+                {"session_id": ObjectId(upload_id), "index": 1}, {"$set": {"data": b"altro", "sha256": "diverso"}})
+        return find(query, projection)
+
+    monkeypatch.setattr(server.upload_chunks_collection, "find", find_and_swap)
+    response = client.post(f"/upload_sessions/{upload_id}/complete", headers=tenant)
+    assert response.status_code == 409
+    assert server.files_collection.count_documents({}) == 0
+    assert client.get(f"/upload_sessions/{upload_id}", headers=tenant).json["status"] == "open"